@@ -0,0 +1,92 @@
+"""
+Time to encode an event listing and the bytes sent for it, with the stdlib JSON encoder
+(FastAPI's JSONResponse) and with orjson, uncompressed and compressed with gzip and brotli.
+
+    python benchmarks/bench_encoding.py [--events 1000 10000] [--repeat 20]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services"))
+
+from fastapi.responses import JSONResponse as StdlibJSONResponse  # noqa: E402
+
+from common.compression import BrotliEncoder, GzipEncoder, brotli  # noqa: E402
+from common.responses import JSONResponse, orjson  # noqa: E402
+
+WORDS = "party meeting dinner concert workshop birthday trip lunch game review".split()
+
+
+def generate_events(count, seed=0):
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    return [
+        {
+            "id": i,
+            "date": (start + timedelta(days=rng.randrange(365))).isoformat(),
+            "organizer": f"user{rng.randrange(1000)}",
+            "title": " ".join(rng.choices(WORDS, k=3)).capitalize(),
+            "description": " ".join(rng.choices(WORDS, k=rng.randrange(5, 30))),
+            "is_public": rng.random() < 0.5,
+        }
+        for i in range(count)
+    ]
+
+
+def best_time(fn, repeat):
+    """Fastest of repeat runs in milliseconds, and the result of the last run."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if orjson is None:
+        print("orjson is not installed, the fast path falls back to the json module")
+
+    encoders = [("gzip", GzipEncoder)]
+    if brotli is not None:
+        encoders.append(("br", BrotliEncoder))
+
+    print(
+        f"{'events':>7} {'encoder':<8} {'coding':<9} {'encode ms':>10} "
+        f"{'compress ms':>12} {'total ms':>9} {'bytes':>10}"
+    )
+    for count in args.events:
+        content = {"events": generate_events(count)}
+        for name, response_class in [
+            ("stdlib", StdlibJSONResponse),
+            ("orjson", JSONResponse),
+        ]:
+            # render() is what a response does with its content
+            response = response_class(content=[])
+            encode_ms, body = best_time(lambda: response.render(content), args.repeat)
+            print(
+                f"{count:>7} {name:<8} {'identity':<9} {encode_ms:>10.2f} "
+                f"{0:>12.2f} {encode_ms:>9.2f} {len(body):>10}"
+            )
+            for coding, encoder_class in encoders:
+                compress_ms, compressed = best_time(
+                    lambda: encoder_class().compress(body, True), args.repeat
+                )
+                print(
+                    f"{count:>7} {name:<8} {coding:<9} {encode_ms:>10.2f} "
+                    f"{compress_ms:>12.2f} {encode_ms + compress_ms:>9.2f} {len(compressed):>10}"
+                )
+
+
+if __name__ == "__main__":
+    main()
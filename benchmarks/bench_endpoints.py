@@ -0,0 +1,614 @@
+"""
+Throughput and latency of every service endpoint and GUI page.
+
+The four services and the GUI are started in this process (uvicorn and werkzeug on
+threads), on fresh databases that are created on the Postgres server given by the
+usual POSTGRES_USER, POSTGRES_PASSWORD, DATABASE_HOST and DATABASE_PORT variables and
+filled with generated data. Every endpoint is then driven over HTTP with --concurrency
+requests in flight, and its throughput and p50/p95/p99 latency are reported.
+
+    python benchmarks/bench_endpoints.py run [--users 1000] [--events 10000] [--output base.json]
+    python benchmarks/bench_endpoints.py compare base.json new.json [--threshold 0.1]
+
+Load generator and servers share one interpreter, so absolute numbers are lower than in
+production; compare runs made on the same machine with the same options.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVICES = os.path.join(ROOT, "services")
+SERVICE_NAMES = ["auth", "events", "invitations", "calendars"]
+
+sys.path.insert(0, SERVICES)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import datagen  # noqa: E402
+
+
+class Endpoint:
+    """An endpoint to benchmark: build(rng, data) returns the method, path and request options."""
+
+    def __init__(self, name, target, build, writes=False, share=1.0):
+        self.name = name
+        self.target = target
+        self.build = build
+        self.writes = writes
+        # Fraction of --requests to send, for endpoints that are slow by design (logins)
+        self.share = share
+
+
+def random_month(rng, data):
+    month = (data.start + timedelta(days=rng.randrange(365))).replace(day=1)
+    last = (month + timedelta(days=31)).replace(day=1) - timedelta(days=1)
+    return month, last
+
+
+def random_invitation(rng, data):
+    return data.invitations[rng.randrange(len(data.invitations))]
+
+
+def build_endpoints():
+    def events_month(rng, data):
+        first, last = random_month(rng, data)
+        return "GET", "/events/", {"params": {"from": str(first), "to": str(last)}}
+
+    def calendar(rng, data):
+        first, last = random_month(rng, data)
+        params = {
+            "status": ["Participate", "Maybe Participate"],
+            "from": str(first),
+            "to": str(last),
+        }
+        return "GET", f"/calendar/{rng.choice(data.users)}", {"params": params}
+
+    def create_event(rng, data):
+        event = {
+            "date": str(data.start + timedelta(days=rng.randrange(365))),
+            "organizer": rng.choice(data.users),
+            "title": " ".join(rng.choices(datagen.WORDS, k=3)),
+            "description": " ".join(rng.choices(datagen.WORDS, k=10)),
+            "is_public": rng.random() < 0.5,
+        }
+        return "POST", "/events/", {"json": event}
+
+    def invite(rng, data):
+        event_id = rng.randrange(1, len(data.events) + 1)
+        invitations = [
+            {"event_id": event_id, "invitee": invitee, "status": "Pending"}
+            for invitee in rng.sample(data.users, 5)
+        ]
+        return "POST", "/invitations/batch", {"json": {"invitations": invitations}}
+
+    def respond(rng, data):
+        invitation = random_invitation(rng, data)
+        path = f"/invitations/{invitation['event_id']}/{invitation['invitee']}"
+        status = rng.choice(datagen.STATUSES)
+        return "PATCH", path, {"params": {"status": status}}
+
+    def share(rng, data):
+        owner, shared_with = rng.sample(data.users, 2)
+        return "PUT", "/share", {"json": {"owner": owner, "shared_with": shared_with}}
+
+    def gui_calendar(rng, data):
+        month, _ = random_month(rng, data)
+        return "GET", "/calendar", {"params": {"month": month.strftime("%Y-%m")}}
+
+    return [
+        Endpoint(
+            "events.list_public",
+            "events",
+            lambda rng, data: (
+                "GET",
+                "/events/",
+                {"params": {"is_public": "true", "limit": 50}},
+            ),
+        ),
+        Endpoint(
+            "events.by_id",
+            "events",
+            lambda rng, data: (
+                "GET",
+                "/events/",
+                {"params": {"id": rng.sample(range(1, len(data.events) + 1), 10)}},
+            ),
+        ),
+        Endpoint("events.month", "events", events_month),
+        Endpoint(
+            "events.search",
+            "events",
+            lambda rng, data: (
+                "GET",
+                "/events/search",
+                {"params": {"q": rng.choice(datagen.WORDS), "limit": 20}},
+            ),
+        ),
+        Endpoint(
+            "invitations.list",
+            "invitations",
+            lambda rng, data: (
+                "GET",
+                "/invitations/",
+                {"params": {"invitee": rng.choice(data.users), "status": "Pending"}},
+            ),
+        ),
+        Endpoint("invitations.calendar", "invitations", calendar),
+        Endpoint(
+            "calendars.check",
+            "calendars",
+            lambda rng, data: (
+                "GET",
+                "/share",
+                {
+                    "params": dict(
+                        zip(("owner", "shared_with"), rng.choice(data.shares))
+                    )
+                },
+            ),
+        ),
+        Endpoint(
+            "calendars.shared",
+            "calendars",
+            lambda rng, data: (
+                "GET",
+                "/calendars/shared",
+                {"params": {"shared_with": rng.choice(data.users)}},
+            ),
+        ),
+        Endpoint(
+            "auth.login",
+            "auth",
+            lambda rng, data: (
+                "POST",
+                "/login/",
+                {
+                    "json": {
+                        "username": rng.choice(data.users),
+                        "password": datagen.PASSWORD,
+                    }
+                },
+            ),
+            share=0.1,
+        ),
+        Endpoint("gui.home", "gui", lambda rng, data: ("GET", "/", {})),
+        Endpoint("gui.calendar", "gui", gui_calendar),
+        Endpoint("gui.invites", "gui", lambda rng, data: ("GET", "/invites", {})),
+        Endpoint(
+            "gui.event",
+            "gui",
+            lambda rng, data: (
+                "GET",
+                f"/event/{rng.randrange(1, len(data.events) + 1)}",
+                {},
+            ),
+        ),
+        # Writes last, they invalidate the caches the reads above use
+        Endpoint("events.create", "events", create_event, writes=True),
+        Endpoint("invitations.batch", "invitations", invite, writes=True),
+        Endpoint("invitations.respond", "invitations", respond, writes=True),
+        Endpoint("calendars.share", "calendars", share, writes=True),
+    ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_module(name, directory):
+    """Import directory/app.py as name, with the modules next to it importable."""
+    sys.path.insert(0, directory)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            name, os.path.join(directory, "app.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        # Flask finds its templates from the module's entry in sys.modules
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+    # auth and the GUI both have a sessions module
+    sys.modules.pop("sessions", None)
+    return module
+
+
+def create_databases(prefix):
+    import psycopg
+
+    from common.db import conninfo
+    from common.migrations import migrate_database
+
+    with psycopg.connect(conninfo("postgres"), autocommit=True) as conn:
+        for name in SERVICE_NAMES:
+            conn.execute(f"DROP DATABASE IF EXISTS {prefix}_{name}")
+            conn.execute(f"CREATE DATABASE {prefix}_{name}")
+    for name in SERVICE_NAMES:
+        migrate_database(f"{prefix}_{name}", os.path.join(SERVICES, name, "migrations"))
+
+
+def seed(prefix, data, password_hash):
+    import psycopg
+
+    from common.db import conninfo
+
+    def copy(dbname, statement, rows):
+        with psycopg.connect(conninfo(f"{prefix}_{dbname}")) as conn:
+            with conn.cursor() as cur:
+                with cur.copy(statement) as copy:
+                    for row in rows:
+                        copy.write_row(row)
+            conn.commit()
+
+    copy(
+        "auth",
+        "COPY auth (username, password) FROM STDIN",
+        ((username, password_hash) for username in data.users),
+    )
+    copy(
+        "events",
+        "COPY events (id, date, organizer, title, description, is_public) FROM STDIN",
+        (
+            (
+                e["id"],
+                e["date"],
+                e["organizer"],
+                e["title"],
+                e["description"],
+                e["is_public"],
+            )
+            for e in data.events
+        ),
+    )
+    copy(
+        "invitations",
+        "COPY invitations (event_id, invitee, status) FROM STDIN",
+        ((i["event_id"], i["invitee"], i["status"]) for i in data.invitations),
+    )
+    copy(
+        "invitations",
+        "COPY calendar_entries (invitee, event_id, status, title, date, organizer, is_public) FROM STDIN",
+        (
+            (
+                i["invitee"],
+                i["event_id"],
+                i["status"],
+                *(
+                    data.events[i["event_id"] - 1][key]
+                    for key in ("title", "date", "organizer", "is_public")
+                ),
+            )
+            for i in data.invitations
+        ),
+    )
+    copy(
+        "calendars",
+        "COPY calendar_shares (owner, shared_with) FROM STDIN",
+        data.shares,
+    )
+
+    with psycopg.connect(conninfo(f"{prefix}_events"), autocommit=True) as conn:
+        conn.execute("SELECT setval('events_id_seq', (SELECT max(id) FROM events))")
+    for name in SERVICE_NAMES:
+        with psycopg.connect(conninfo(f"{prefix}_{name}"), autocommit=True) as conn:
+            conn.execute("ANALYZE")
+
+
+class Servers:
+    """The services and the GUI, each served on its own port from a thread of this process."""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ports = {name: free_port() for name in SERVICE_NAMES + ["gui"]}
+        self.urls = {
+            name: f"http://127.0.0.1:{port}" for name, port in self.ports.items()
+        }
+        self.modules = {}
+        self._uvicorn = []
+        self._threads = []
+        self._gui = None
+
+    def start(self):
+        import uvicorn
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+        os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+        os.environ["EVENTS_SERVICE_URL"] = self.urls["events"]
+
+        for name in SERVICE_NAMES:
+            module = load_module(f"{name}_app", os.path.join(SERVICES, name))
+            # The services name their database after themselves, point them at the benchmark's
+            dbname = f"{self.prefix}_{name}"
+            module.pool.dbname = dbname
+            if hasattr(module, "changes"):
+                module.changes.dbname = dbname
+            self.modules[name] = module
+
+            server = uvicorn.Server(
+                uvicorn.Config(
+                    module.app,
+                    host="127.0.0.1",
+                    port=self.ports[name],
+                    log_level="warning",
+                )
+            )
+            self._start_thread(server.run)
+            self._uvicorn.append(server)
+
+        gui = load_module("gui_app", os.path.join(ROOT, "gui"))
+        for name in SERVICE_NAMES:
+            getattr(gui, f"{name}_service").base_url = self.urls[name]
+        self.modules["gui"] = gui
+        self._gui = make_server("127.0.0.1", self.ports["gui"], gui.app, threaded=True)
+        self._start_thread(self._gui.serve_forever)
+
+        for server in self._uvicorn:
+            while not server.started:
+                time.sleep(0.05)
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        for server in self._uvicorn:
+            server.should_exit = True
+        if self._gui is not None:
+            self._gui.shutdown()
+        for thread in self._threads:
+            thread.join(timeout=10)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def drive(endpoint, base_url, data, requests, concurrency, seed, cookies):
+    """Send requests requests to endpoint with concurrency in flight, returns its stats."""
+    import httpx
+
+    rng = random.Random(seed)
+    calls = [endpoint.build(rng, data) for _ in range(requests)]
+    latencies = []
+    errors = 0
+    next_call = 0
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=60, cookies=cookies
+    ) as client:
+
+        async def worker():
+            nonlocal next_call, errors
+            while next_call < len(calls):
+                method, path, options = calls[next_call]
+                next_call += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, path, **options)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                latencies.append(time.perf_counter() - start)
+                errors += failed
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": requests / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(
+        f"{'endpoint':<22} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    for name, stats in results.items():
+        print(
+            f"{name:<22} {stats['throughput']:>8.1f} {stats['p50_ms']:>8.2f} "
+            f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['errors']:>7}"
+        )
+
+
+def run(args):
+    for variable in ("POSTGRES_USER", "POSTGRES_PASSWORD", "DATABASE_HOST"):
+        if variable not in os.environ:
+            sys.exit(f"{variable} must be set to the Postgres server to benchmark on")
+    os.environ.setdefault("SESSION_SECRET", "benchmark")
+
+    data = datagen.generate(
+        users=args.users,
+        events=args.events,
+        invitations_per_user=args.invitations,
+        shares_per_user=args.shares,
+        seed=args.seed,
+    )
+    print(f"Generating {data.summary()}", file=sys.stderr)
+
+    create_databases(args.db_prefix)
+    servers = Servers(args.db_prefix)
+    servers.start()
+    try:
+        auth = servers.modules["auth"]
+        seed(args.db_prefix, data, auth.hash_password(datagen.PASSWORD))
+
+        # GUI pages are requested as a logged in user
+        user = data.users[0]
+        cookies = {"session": auth.issue_session_token(1, user)}
+
+        results = {}
+        for number, endpoint in enumerate(build_endpoints()):
+            if args.only and not any(name in endpoint.name for name in args.only):
+                continue
+            if args.read_only and endpoint.writes:
+                continue
+            requests = max(args.concurrency, int(args.requests * endpoint.share))
+            print(f"Running {endpoint.name} ({requests} requests)", file=sys.stderr)
+            results[endpoint.name] = asyncio.run(
+                drive(
+                    endpoint,
+                    servers.urls[endpoint.target],
+                    data,
+                    requests,
+                    args.concurrency,
+                    args.seed + number,
+                    cookies,
+                )
+            )
+    finally:
+        servers.stop()
+
+    print_results(results)
+    if args.output:
+        report = {
+            "meta": {
+                "commit": git_commit(),
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "dataset": data.summary(),
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "seed": args.seed,
+            },
+            "endpoints": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+
+
+def compare(args):
+    """Print the change of every endpoint between two runs, exits with 1 if any regressed."""
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    if base["meta"]["dataset"] != new["meta"]["dataset"]:
+        print("Warning: the runs used different datasets", file=sys.stderr)
+
+    print(
+        f"{'endpoint':<22} {'req/s':>17} {'p50 ms':>17} {'p95 ms':>17} {'p99 ms':>17}  verdict"
+    )
+    regressions = []
+    for name, before in base["endpoints"].items():
+        after = new["endpoints"].get(name)
+        if after is None:
+            continue
+
+        columns = []
+        regressed = False
+        for key, higher_is_better in [
+            ("throughput", True),
+            ("p50_ms", False),
+            ("p95_ms", False),
+            ("p99_ms", False),
+        ]:
+            change = (after[key] - before[key]) / before[key] if before[key] else 0.0
+            worse = -change if higher_is_better else change
+            # p99 is too noisy on short runs to fail a comparison on its own
+            if key != "p99_ms" and worse > args.threshold:
+                regressed = True
+            columns.append(f"{after[key]:>8.2f} ({change:>+6.1%})")
+        if after["errors"] > before["errors"]:
+            regressed = True
+
+        verdict = "REGRESSION" if regressed else "ok"
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<22} {' '.join(columns)}  {verdict}")
+
+    if regressions:
+        print(f"{len(regressions)} endpoint(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark every endpoint")
+    run_parser.add_argument("--users", type=int, default=1000)
+    run_parser.add_argument("--events", type=int, default=10000)
+    run_parser.add_argument(
+        "--invitations", type=int, default=20, help="invitations per user"
+    )
+    run_parser.add_argument("--shares", type=int, default=2, help="shares per user")
+    run_parser.add_argument(
+        "--requests", type=int, default=500, help="requests per endpoint"
+    )
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument(
+        "--only", nargs="+", help="only run endpoints whose name contains one of these"
+    )
+    run_parser.add_argument(
+        "--read-only", action="store_true", help="skip the endpoints that write"
+    )
+    run_parser.add_argument(
+        "--db-prefix",
+        default="bench",
+        help="databases <prefix>_<service> are dropped and recreated",
+    )
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change of throughput, p50 or p95 that counts as a regression",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
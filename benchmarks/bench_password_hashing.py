@@ -0,0 +1,53 @@
+"""
+Logins per second of the auth service's password verification, inline and on
+HashingPool with an increasing number of worker processes.
+
+    python benchmarks/bench_password_hashing.py [--logins 200] [--max-workers 8]
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "auth"))
+
+from passwords import HashingPool, hash_password, verify_password  # noqa: E402
+
+
+def logins_per_second(verify, stored, logins, concurrency):
+    # Requests arrive on FastAPI's threadpool, so verify from several threads at once
+    with ThreadPoolExecutor(max_workers=concurrency) as requests:
+        start = time.perf_counter()
+        results = list(requests.map(lambda _: verify("secret", stored), range(logins)))
+        elapsed = time.perf_counter() - start
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    stored = hash_password("secret")
+    concurrency = args.max_workers * 4
+
+    inline = logins_per_second(verify_password, stored, args.logins, concurrency)
+    print(f"{'mode':<12} {'workers':>7} {'logins/s':>10} {'speedup':>8}")
+    print(f"{'inline':<12} {'-':>7} {inline:>10.1f} {1:>8.2f}")
+
+    workers = 1
+    while workers <= args.max_workers:
+        hashing = HashingPool(workers=workers, queue=concurrency)
+        hashing.start()
+        rate = logins_per_second(hashing.verify, stored, args.logins, concurrency)
+        hashing.shutdown()
+        print(f"{'processes':<12} {workers:>7} {rate:>10.1f} {rate / inline:>8.2f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Deterministic test data for the benchmarks: users, the events they organize, the
+invitations they receive and the calendars they share, shaped like real usage.
+"""
+
+import random
+from datetime import date, timedelta
+
+WORDS = (
+    "party meeting dinner concert workshop birthday trip lunch game review "
+    "music food code sports books travel jazz movie hike picnic"
+).split()
+
+STATUSES = ["Pending", "Participate", "Maybe Participate", "Don't Participate"]
+STATUS_WEIGHTS = [4, 3, 2, 1]
+
+PASSWORD = "password"
+
+
+class Dataset:
+    def __init__(self, users, events, invitations, shares, start):
+        self.users = users
+        self.events = events
+        self.invitations = invitations
+        self.shares = shares
+        self.start = start
+
+    def summary(self):
+        return {
+            "users": len(self.users),
+            "events": len(self.events),
+            "invitations": len(self.invitations),
+            "shares": len(self.shares),
+        }
+
+
+def generate(
+    users=1000,
+    events=10000,
+    invitations_per_user=20,
+    shares_per_user=2,
+    days=365,
+    seed=0,
+):
+    """
+    users users, events events spread over days days, every user invited to
+    invitations_per_user events and sharing their calendar with shares_per_user users.
+    Event ids are 1..events, in the order they are returned.
+    """
+    rng = random.Random(seed)
+    start = date(2024, 1, 1)
+    usernames = [f"user{i:05d}" for i in range(users)]
+
+    event_rows = []
+    for event_id in range(1, events + 1):
+        event_rows.append(
+            {
+                "id": event_id,
+                "date": (start + timedelta(days=rng.randrange(days))).isoformat(),
+                "organizer": rng.choice(usernames),
+                "title": " ".join(rng.choices(WORDS, k=3)).capitalize(),
+                "description": " ".join(rng.choices(WORDS, k=rng.randrange(5, 30))),
+                "is_public": rng.random() < 0.5,
+            }
+        )
+
+    invitation_rows = []
+    for username in usernames:
+        for event_id in rng.sample(
+            range(1, events + 1), min(invitations_per_user, events)
+        ):
+            invitation_rows.append(
+                {
+                    "event_id": event_id,
+                    "invitee": username,
+                    "status": rng.choices(STATUSES, STATUS_WEIGHTS)[0],
+                }
+            )
+
+    share_rows = []
+    for username in usernames:
+        others = rng.sample(usernames, min(shares_per_user + 1, users))
+        others = [other for other in others if other != username][:shares_per_user]
+        share_rows.extend((username, other) for other in others)
+
+    return Dataset(usernames, event_rows, invitation_rows, share_rows, start)
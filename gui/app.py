@@ -1,5 +1,25 @@
-from flask import Flask, render_template, redirect, request, make_response
+from flask import (
+    Flask,
+    render_template,
+    redirect,
+    request,
+    make_response,
+    g,
+    jsonify,
+    url_for,
+)
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextvars
+import os
+import time
 import requests
+from datetime import date, datetime, timedelta
+from functools import wraps
+from urllib.parse import quote
+from backend import BackendClient, deadline
+from metrics import instrument, metrics_response
+from tracing import trace_requests
+from sessions import SESSION_COOKIE, SESSION_TTL, verify_session_token
 from flasgger import Swagger
 
 swagger_config = {
@@ -19,56 +39,153 @@ swagger_config = {
 
 app = Flask(__name__)
 swagger = Swagger(app, config=swagger_config)
+instrument(app)
+trace_requests(app)
 
 AUTH_SERVICE_URL = "http://auth:5000"
 EVENTS_SERVICE_URL = "http://events:5000"
 INVITATIONS_SERVICE_URL = "http://invitations:5000"
 CALENDARS_SERVICE_URL = "http://calendars:5000"
 
-# The Username & Password of the currently logged-in User, this is used as a pseudo-cookie, as such this is not session-specific.
-username = None
-password = None
+auth_service = BackendClient("auth", AUTH_SERVICE_URL)
+events_service = BackendClient("events", EVENTS_SERVICE_URL)
+invitations_service = BackendClient("invitations", INVITATIONS_SERVICE_URL)
+calendars_service = BackendClient("calendars", CALENDARS_SERVICE_URL)
+backend_services = (
+    auth_service,
+    events_service,
+    invitations_service,
+    calendars_service,
+)
 
-session_data = dict()
+# Independent backend calls of a page are issued concurrently on this pool, a page
+# waits at most PAGE_DEADLINE seconds in total for its backend calls
+backend_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("GUI_FANOUT_WORKERS", 32))
+)
+PAGE_DEADLINE = float(os.environ.get("GUI_PAGE_DEADLINE", 5))
 
+HOME_PAGE_SIZE = int(os.environ.get("GUI_HOME_PAGE_SIZE", 50))
 
-def save_to_session(key, value):
-    session_data[key] = value
 
+def current_user():
+    """The user of the session cookie of the current request, None if not logged in."""
+    if "username" not in g:
+        g.username = verify_session_token(request.cookies.get(SESSION_COOKIE))
+    return g.username
 
-def load_from_session(key):
-    return (
-        session_data.pop(key) if key in session_data else None
-    )  # Pop to ensure that it is only used once
+
+def login_required(view):
+    """Send requests without a valid session to the login page (the homepage when logged out)."""
+
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        if current_user() is None:
+            return redirect("/")
+        return view(*args, **kwargs)
+
+    return guarded
+
+
+def start_session(response, token):
+    response.set_cookie(
+        SESSION_COOKIE, token, max_age=SESSION_TTL, httponly=True, samesite="Lax"
+    )
 
 
 def succesful_request(r):
     return r.status_code == 200 or r.status_code == 201
 
 
+@app.before_request
+def start_page_deadline():
+    g.deadline = time.monotonic() + PAGE_DEADLINE
+    # Backend requests of the page don't wait or retry past it
+    deadline.set(g.deadline)
+
+
+@app.teardown_request
+def end_page_deadline(error):
+    deadline.set(None)
+
+
+def fan_out(*calls):
+    """
+    Run independent backend calls concurrently and return their results in order.
+    A call that raised, or did not finish before the page deadline, yields None (as does a call that is None).
+    """
+    # Each call runs in a copy of the request's context, so its spans belong to the page's trace
+    futures = [
+        backend_executor.submit(contextvars.copy_context().run, call) if call else None
+        for call in calls
+    ]
+    pending = [future for future in futures if future is not None]
+    wait(pending, timeout=max(g.deadline - time.monotonic(), 0))
+
+    results = []
+    for future in futures:
+        if future is None or not future.done():
+            if future is not None:
+                future.cancel()
+            results.append(None)
+        elif future.exception() is not None:
+            results.append(None)
+        else:
+            results.append(future.result())
+    return results
+
+
+@app.route("/metrics")
+def metrics():
+    return metrics_response()
+
+
+@app.route("/backend/stats")
+def backend_stats():
+    return jsonify([service.stats() for service in backend_services])
+
+
+@app.context_processor
+def unavailable_services():
+    """Services whose circuit breaker is open, every page shows a banner while there are any."""
+    return {
+        "unavailable_services": [
+            service.name for service in backend_services if service.breaker.is_open()
+        ]
+    }
+
+
 @app.route("/")
 def home():
-    global username, password
+    username = current_user()
     if username is None:
-        return render_template("login.html", username=username, password=password)
+        return render_template("login.html", username=username)
     else:
-        params = {"is_public": True}
+        # The public events are shown one page at a time from a date on (today by default),
+        # or, with before, going back in time from the day before it. page is the cursor of
+        # the page to show.
+        page = request.args.get("page")
+        before = parse_date(request.args.get("before"))
+        start = parse_date(request.args.get("from")) or date.today()
+        params = {"is_public": True, "limit": HOME_PAGE_SIZE, "cursor": page}
+        if before is not None:
+            params.update(
+                {"to": (before - timedelta(days=1)).isoformat(), "order": "desc"}
+            )
+        else:
+            params["from"] = start.isoformat()
         try:
-            response = requests.get(f"{EVENTS_SERVICE_URL}/events/", params=params)
+            response = events_service.get("/events/", params=params)
             # if the request fails, return the home page with an empty list of events
             if response.status_code != 200:
                 return make_response(
-                    render_template(
-                        "home.html", username=username, password=password, events=[]
-                    ),
+                    render_template("home.html", username=username, events=[]),
                     response.status_code,
                 )
-        except:
+        except requests.RequestException:
             return make_response(
-                render_template(
-                    "home.html", username=username, password=password, events=[]
-                ),
-                400,
+                render_template("home.html", username=username, events=[]),
+                503,
             )
 
         # Destructure the response to get the events
@@ -77,15 +194,41 @@ def home():
             (event["title"], event["date"], event["organizer"]) for event in events
         ]
 
+        # Earlier events link to the events from today on and the other way around
+        if before is not None:
+            bound = {"before": before.isoformat()}
+            switch_url = url_for("home", **{"from": before.isoformat()})
+        else:
+            bound = {"from": start.isoformat()}
+            switch_url = url_for("home", before=start.isoformat())
+        next_cursor = response.json().get("next_cursor")
+
         return make_response(
             render_template(
-                "home.html", username=username, password=password, events=public_events
+                "home.html",
+                username=username,
+                events=public_events,
+                earlier=before is not None,
+                switch_url=switch_url,
+                first_url=url_for("home", **bound) if page is not None else None,
+                next_url=(
+                    url_for("home", page=next_cursor, **bound) if next_cursor else None
+                ),
             ),
             200,
         )
 
 
+def parse_date(value):
+    """A YYYY-MM-DD query parameter, None if it is missing or not a date."""
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
 @app.route("/event", methods=["POST"])
+@login_required
 def create_event():
     """
     Create an event
@@ -119,7 +262,7 @@ def create_event():
         400:
             description: Event creation failed
     """
-    global username, password
+    username = current_user()
     title, description, date, publicprivate, invites = (
         request.form["title"],
         request.form["description"],
@@ -129,8 +272,8 @@ def create_event():
     )
 
     try:
-        response = requests.post(
-            f"{EVENTS_SERVICE_URL}/events/",
+        response = events_service.post(
+            "/events/",
             json={
                 "date": date,
                 "organizer": username,
@@ -141,218 +284,167 @@ def create_event():
         )
         if response.status_code != 201:
             return redirect("/")
-    except:
+    except requests.RequestException:
         return redirect("/")
 
     event_id = response.json().get("event_id", None)
-    invitees = invites.split(";")
-
-    for invitee in invitees:
-        invitee = invitee.strip()
-        if invitee:
-            try:
-                response = requests.post(
-                    f"{INVITATIONS_SERVICE_URL}/invitations/",
-                    json={
-                        "event_id": event_id,
-                        "invitee": invitee,
-                        "status": "Pending",
-                    },
-                )
-                if response.status_code != 201:
-                    return redirect("/")
-            except:
-                return redirect("/")
+    invitees = [invitee.strip() for invitee in invites.split(";")]
 
+    invitations = [
+        {"event_id": event_id, "invitee": invitee, "status": "Pending"}
+        for invitee in dict.fromkeys(invitees)
+        if invitee and invitee != username
+    ]
     # Invite yourself and set status to Participate
-    if username not in invitees:
-        try:
-            response = requests.post(
-                f"{INVITATIONS_SERVICE_URL}/invitations/",
-                json={
-                    "event_id": event_id,
-                    "invitee": username,
-                    "status": "Participate",
-                },
-            )
-        finally:
-            return redirect("/")
+    invitations.append(
+        {"event_id": event_id, "invitee": username, "status": "Participate"}
+    )
 
-    return redirect("/")
+    try:
+        invitations_service.post(
+            "/invitations/batch",
+            json={"invitations": invitations},
+        )
+    finally:
+        return redirect("/")
 
 
 @app.route("/calendar", methods=["GET", "POST"])
+@login_required
 def calendar():
-    global username, password
-    calendar_user = (
-        request.form["calendar_user"] if "calendar_user" in request.form else username
-    )
+    username = current_user()
+    calendar_user = request.values.get("calendar_user") or username
+    shared_calendar = calendar_user != username
 
-    if calendar_user is not username:
-        try:
-            calendar_response = requests.get(
-                f"{CALENDARS_SERVICE_URL}/calendars/", params={"owner": calendar_user}
-            )
+    # Only the events of the month that is shown are fetched
+    try:
+        month = datetime.strptime(request.values.get("month", ""), "%Y-%m").date()
+    except ValueError:
+        month = date.today().replace(day=1)
+    next_month = (month + timedelta(days=31)).replace(day=1)
+    months = {
+        "month": month,
+        "previous_month": (month - timedelta(days=1)).replace(day=1),
+        "next_month": next_month,
+    }
+
+    # The share check and the calendar don't depend on each other, so fetch them together
+    params = {
+        "status": ["Participate", "Maybe Participate"],
+        "from": month.isoformat(),
+        "to": (next_month - timedelta(days=1)).isoformat(),
+    }
+
+    def check_share():
+        return calendars_service.get(
+            "/share", params={"owner": calendar_user, "shared_with": username}
+        )
 
-            # if the request fails, return the calendar page with an empty list of events
-            if calendar_response.status_code != 200:
-                return render_template(
-                    "calendar.html",
-                    username=username,
-                    password=password,
-                    calendar_user=calendar_user,
-                    calendar=[],
-                    success=False,
-                )
-        except:
+    calendar_response, share_response = fan_out(
+        lambda: invitations_service.get(
+            f"/calendar/{quote(calendar_user, safe='')}", params=params
+        ),
+        check_share if shared_calendar else None,
+    )
+
+    if shared_calendar:
+        # if the request fails, return the calendar page with an empty list of events
+        if share_response is None or share_response.status_code != 200:
             return render_template(
                 "calendar.html",
                 username=username,
-                password=password,
                 calendar_user=calendar_user,
                 calendar=[],
                 success=False,
+                **months,
             )
 
-        success = username in calendar_response.json().get("shared_with", [])
+        success = share_response.json().get("shared", False)
     else:
         success = True
 
-    params = {"invitee": calendar_user, "status": "Participate"}
-    try:
-        participating_events = requests.get(
-            f"{INVITATIONS_SERVICE_URL}/invitations/", params=params
-        )
-        if participating_events.status_code != 200:
-            my_invites = []
-        else:
-            my_invites = participating_events.json().get("invitations", [])
-    except:
-        my_invites = []
-
-    params = {"invitee": calendar_user, "status": "Maybe Participate"}
-
-    try:
-        maybe_participating_events = requests.get(
-            f"{INVITATIONS_SERVICE_URL}/invitations/",
-            params=params,
-        )
-        if maybe_participating_events.status_code != 200:
-            my_invites += []
-        else:
-            my_invites += maybe_participating_events.json().get("invitations", [])
-    except:
-        my_invites += []
-
-    if success:
+    if not success:
+        calendar = None
+    elif calendar_response is None or calendar_response.status_code != 200:
         calendar = []
-        for invite in my_invites:
-            event_id = invite["event_id"]
-            params = {"id": event_id}
-            try:
-                event_response = requests.get(
-                    f"{EVENTS_SERVICE_URL}/events/",
-                    params=params,
-                )
-            except:
-                continue
-
-            if event_response.status_code == 200:
-                event = event_response.json().get("events", [])[0]
-                calendar.append(
-                    (
-                        event_id,
-                        event["title"],
-                        event["date"],
-                        event["organizer"],
-                        invite["status"],
-                        "Public" if event["is_public"] else "Private",
-                    )
-                )
     else:
-        calendar = None
+        calendar = [
+            (
+                entry["event_id"],
+                entry["title"],
+                entry["date"],
+                entry["organizer"],
+                entry["status"],
+                "Public" if entry["is_public"] else "Private",
+            )
+            for entry in calendar_response.json().get("calendar", [])
+        ]
 
     return render_template(
         "calendar.html",
         username=username,
-        password=password,
         calendar_user=calendar_user,
         calendar=calendar,
         success=success,
+        **months,
     )
 
 
 @app.route("/share", methods=["GET"])
+@login_required
 def share_page():
-    global username, password
-    return render_template(
-        "share.html", username=username, password=password, success=None
-    )
+    username = current_user()
+    return render_template("share.html", username=username, success=None)
 
 
 @app.route("/share", methods=["POST"])
+@login_required
 def share():
-    global username, password
+    username = current_user()
     share_user = request.form["username"]
 
     try:
-        response = requests.put(
-            f"{CALENDARS_SERVICE_URL}/share",
+        response = calendars_service.put(
+            "/share",
             json={"owner": username, "shared_with": share_user},
         )
         success = succesful_request(response)
-    except:
+    except requests.RequestException:
         success = False
 
-    return render_template(
-        "share.html", username=username, password=password, success=success
-    )
+    return render_template("share.html", username=username, success=success)
 
 
 @app.route("/event/<eventid>")
+@login_required
 def view_event(eventid):
-    global username, password
-    params = {"event": eventid}
+    username = current_user()
 
-    try:
-        invitations_response = requests.get(
-            f"{INVITATIONS_SERVICE_URL}/invitations/",
-            params=params,
-        )
-        if invitations_response.status_code != 200:
-            invitations = []
-        else:
-            invitations = invitations_response.json().get("invitations", [])
-    except:
+    invitations_response, event_response = fan_out(
+        lambda: invitations_service.get("/invitations/", params={"event": eventid}),
+        lambda: events_service.get("/events/", params={"id": eventid}),
+    )
+
+    if invitations_response is None or invitations_response.status_code != 200:
         invitations = []
+    else:
+        invitations = invitations_response.json().get("invitations", [])
 
     success = username in [invite["invitee"] for invite in invitations]
 
-    params = {"id": eventid}
-
-    try:
-        event_response = requests.get(
-            f"{EVENTS_SERVICE_URL}/events/",
-            params=params,
-        )
-        if event_response.status_code != 200:
-            return render_template(
-                "event.html",
-                username=username,
-                password=password,
-                event={},
-                success=success,
-            )
-        else:
-            event = event_response.json().get("events", [])[0]
-    except:
+    events = (
+        event_response.json().get("events", [])
+        if event_response is not None and event_response.status_code == 200
+        else []
+    )
+    if not events:
         return render_template(
             "event.html",
             username=username,
-            password=password,
             event={},
             success=success,
         )
+    event = events[0]
     success = success or event["is_public"]
 
     if success:
@@ -368,7 +460,7 @@ def view_event(eventid):
         event = None  # No success, so don't fetch the data
 
     return render_template(
-        "event.html", username=username, password=password, event=event, success=success
+        "event.html", username=username, event=event, success=success
     )
 
 
@@ -394,43 +486,41 @@ def login():
         401:
             description: Login failed
     """
-    global username, password
+    username = current_user()
     req_username, req_password = request.form["username"], request.form["password"]
 
     try:
-        response = requests.post(
-            f"{AUTH_SERVICE_URL}/login/",
+        response = auth_service.post(
+            "/login/",
             json={"username": req_username, "password": req_password},
         )
         success = succesful_request(response)
-    except:
+    except requests.RequestException:
         return make_response(
             render_template(
                 "login.html",
                 username=username,
-                password=password,
                 success=False,
                 login=True,
             ),
             401,
         )
 
-    save_to_session("success", success)
-
     if success:
         username = req_username
-        password = req_password
 
-    return make_response(
+    page = make_response(
         render_template(
             "login.html",
             username=username,
-            password=password,
             success=success,
             login=True,
         ),
         200,
     )
+    if success:
+        start_session(page, response.json()["token"])
+    return page
 
 
 @app.route("/register", methods=["POST"])
@@ -455,106 +545,87 @@ def register():
         400:
             description: Registration failed
     """
-    global username, password
+    username = current_user()
     req_username, req_password = request.form["username"], request.form["password"]
 
     try:
-        response = requests.post(
-            f"{AUTH_SERVICE_URL}/register/",
+        response = auth_service.post(
+            "/register/",
             json={"username": req_username, "password": req_password},
         )
         success = succesful_request(response)
-    except:
+    except requests.RequestException:
         return make_response(
             render_template(
                 "login.html",
                 username=username,
-                password=password,
                 success=False,
                 registration=True,
             ),
             400,
         )
 
-    save_to_session("success", success)
-
     if success:
         username = req_username
-        password = req_password
 
-    return make_response(
+    page = make_response(
         render_template(
             "login.html",
             username=username,
-            password=password,
             success=success,
             registration=True,
         ),
         200,
     )
+    if success:
+        start_session(page, response.json()["token"])
+    return page
 
 
 @app.route("/invites", methods=["GET"])
+@login_required
 def invites():
-    global username, password
-    params = {"invitee": username, "status": "Pending"}
-
-    try:
-        response = requests.get(
-            f"{INVITATIONS_SERVICE_URL}/invitations/",
-            params=params,
+    username = current_user()
+    (response,) = fan_out(
+        lambda: invitations_service.get(
+            f"/calendar/{quote(username, safe='')}", params={"status": "Pending"}
         )
-        if response.status_code != 200:
-            my_invites = []
-        else:
-            my_invites = response.json().get("invitations", [])
-    except:
-        my_invites = []
-
-    invites = []
-    for invite in my_invites:
-        event_id = invite["event_id"]
-        params = {"id": event_id}
-        try:
-            event_response = requests.get(
-                f"{EVENTS_SERVICE_URL}/events/",
-                params=params,
-            )
-
-            if event_response.status_code == 200:
-                event = event_response.json().get("events", [])[0]
-                invites.append(
-                    (
-                        event_id,
-                        event["title"],
-                        event["date"],
-                        event["organizer"],
-                        event["is_public"],
-                    )
-                )
-        except:
-            continue
+    )
+    if response is None or response.status_code != 200:
+        entries = []
+    else:
+        entries = response.json().get("calendar", [])
+
+    invites = [
+        (
+            entry["event_id"],
+            entry["title"],
+            entry["date"],
+            entry["organizer"],
+            entry["is_public"],
+        )
+        for entry in entries
+    ]
 
     return make_response(
-        render_template(
-            "invites.html", username=username, password=password, invites=invites
-        ),
+        render_template("invites.html", username=username, invites=invites),
         200,
     )
 
 
 @app.route("/invites", methods=["POST"])
+@login_required
 def process_invite():
-    global username, password
+    username = current_user()
     eventId, status = request.json["event"], request.json["status"]
 
     params = {"invitee": username, "event": eventId, "status": status}
     try:
-        requests.patch(
-            f"{INVITATIONS_SERVICE_URL}/invitations/{eventId}/{username}",
+        invitations_service.patch(
+            f"/invitations/{eventId}/{quote(username, safe='')}",
             params=params,
         )
-    except:
+    except requests.RequestException:
         return redirect("/invites")
 
     return redirect("/invites")
@@ -562,8 +633,6 @@ def process_invite():
 
 @app.route("/logout")
 def logout():
-    global username, password
-
-    username = None
-    password = None
-    return redirect("/")
+    response = redirect("/")
+    response.delete_cookie(SESSION_COOKIE)
+    return response
@@ -0,0 +1,349 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import BACKEND_DURATION
+from tracing import span, traceparent_headers
+
+
+def _env(service, name, default):
+    """Per-service setting (GUI_EVENTS_POOL_SIZE) falling back to the global one (GUI_BACKEND_POOL_SIZE)."""
+    return os.environ.get(
+        f"GUI_{service.upper()}_{name}",
+        os.environ.get(f"GUI_BACKEND_{name}", default),
+    )
+
+
+# Requests that can be sent again without changing the result
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+# Responses of a service that is down or overloaded, worth retrying
+RETRY_STATUSES = {502, 503, 504}
+
+# time.monotonic() by which the calls of the current page must be done, set by the app for
+# every request. Requests in this context are cut short at it and not retried after it.
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class BackendUnavailable(requests.RequestException):
+    """Raised without sending the request while the circuit breaker of a service is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a service after failure_threshold consecutive failures (no response,
+    or a 5xx response). After reset_timeout seconds one request is let through, if it
+    succeeds the breaker closes again, if it fails it stays open for another reset_timeout.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "rejected": 0}
+
+    def allow(self):
+        """Whether a request may be sent now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                # Let a single trial request through
+                self.state = self.HALF_OPEN
+                return True
+            self._stats["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._stats["opened"] += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def is_open(self):
+        with self._lock:
+            return self.state != self.CLOSED
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, **self._stats}
+
+
+class RetryBudget:
+    """
+    Limits retries to a fraction of the requests: every request deposits ratio of a
+    retry, a retry withdraws a whole one. The balance is capped at max_balance, so
+    after a quiet period a burst of at most max_balance retries is allowed. This keeps
+    retries from multiplying the load on a service that is already failing.
+    """
+
+    def __init__(self, ratio, max_balance=10.0):
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self._balance = max_balance
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._balance + self.ratio, self.max_balance)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+def _cut_timeout(timeout, ends_at):
+    """
+    timeout (seconds, or a (connect, read) tuple) cut to the time left until ends_at. A request
+    made once ends_at has passed (the page is late already) keeps its timeout.
+    """
+    if ends_at is None:
+        return timeout
+    left = ends_at - time.monotonic()
+    if left <= 0:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+class BackendClient:
+    """
+    HTTP client for one backend service. Connections to the service are kept alive
+    in a pool and reused between requests, and every request has a connect and read timeout.
+
+    Responses to GET requests that carry an ETag are kept in an LRU cache of cache_size
+    entries, a later GET of the same URL is sent as a conditional request and a 304 is
+    answered with the cached response. When the service can't be reached the cached
+    response is returned instead of failing.
+
+    A circuit breaker fails requests immediately with BackendUnavailable while the service
+    is down. Idempotent requests that failed to connect or got a 502, 503 or 504 are
+    retried up to retries times, after a random backoff that doubles every attempt, as
+    long as the retry budget allows it and the retry can be sent before the deadline.
+    """
+
+    def __init__(
+        self,
+        name,
+        base_url,
+        pool_size=None,
+        connect_timeout=None,
+        read_timeout=None,
+        cache_size=None,
+        retries=None,
+        retry_backoff=None,
+        retry_budget=None,
+        breaker_threshold=None,
+        breaker_reset_timeout=None,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.pool_size = int(pool_size or _env(name, "POOL_SIZE", 32))
+        self.timeout = (
+            float(connect_timeout or _env(name, "CONNECT_TIMEOUT", 1)),
+            float(read_timeout or _env(name, "READ_TIMEOUT", 5)),
+        )
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+        self.cache_size = int(
+            cache_size if cache_size is not None else _env(name, "CACHE_SIZE", 1024)
+        )
+        self._cache = OrderedDict()
+
+        self.retries = int(retries if retries is not None else _env(name, "RETRIES", 2))
+        self.retry_backoff = float(retry_backoff or _env(name, "RETRY_BACKOFF", 0.05))
+        self.retry_budget = RetryBudget(
+            float(retry_budget or _env(name, "RETRY_BUDGET", 0.1))
+        )
+        self.breaker = CircuitBreaker(
+            int(breaker_threshold or _env(name, "BREAKER_THRESHOLD", 5)),
+            float(breaker_reset_timeout or _env(name, "BREAKER_RESET_TIMEOUT", 10)),
+        )
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "errors": 0,
+            "not_modified": 0,
+            "retries": 0,
+            "retries_denied": 0,
+            "retries_past_deadline": 0,
+            "stale_responses": 0,
+        }
+
+    def request(self, method, path, **kwargs):
+        timeout = kwargs.pop("timeout", self.timeout)
+        with self._lock:
+            self._stats["requests"] += 1
+        self.retry_budget.deposit()
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        ends_at = deadline.get()
+
+        attempt = 0
+        while True:
+            # Full jitter, so clients that failed together don't retry together
+            backoff = random.uniform(0, self.retry_backoff * 2 ** (attempt + 1))
+            try:
+                response = self._send(
+                    method, path, timeout=_cut_timeout(timeout, ends_at), **kwargs
+                )
+            except BackendUnavailable:
+                raise
+            except requests.ConnectionError:
+                if not self._may_retry(attempt, retries, backoff, ends_at):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or not self._may_retry(
+                    attempt, retries, backoff, ends_at
+                ):
+                    return response
+            attempt += 1
+            time.sleep(backoff)
+
+    def _may_retry(self, attempt, retries, backoff, ends_at):
+        if attempt >= retries:
+            return False
+        # Nobody waits for the result of a retry sent after the deadline
+        if ends_at is not None and time.monotonic() + backoff >= ends_at:
+            with self._lock:
+                self._stats["retries_past_deadline"] += 1
+            return False
+        if not self.retry_budget.withdraw():
+            with self._lock:
+                self._stats["retries_denied"] += 1
+            return False
+        with self._lock:
+            self._stats["retries"] += 1
+        return True
+
+    def _send(self, method, path, **kwargs):
+        """Send a request once, through the circuit breaker."""
+        if not self.breaker.allow():
+            raise BackendUnavailable(f"The {self.name} service is unavailable")
+
+        start = time.perf_counter()
+        with span(f"{method} {self.name}", **{"http.target": path}) as call_span:
+            kwargs["headers"] = {
+                **traceparent_headers(),
+                **(kwargs.get("headers") or {}),
+            }
+            try:
+                response = self.session.request(
+                    method, f"{self.base_url}{path}", **kwargs
+                )
+            except requests.RequestException:
+                self.breaker.record_failure()
+                BACKEND_DURATION.labels(self.name, method, "error").observe(
+                    time.perf_counter() - start
+                )
+                with self._lock:
+                    self._stats["errors"] += 1
+                raise
+            if call_span is not None:
+                call_span.set("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        BACKEND_DURATION.labels(self.name, method, str(response.status_code)).observe(
+            time.perf_counter() - start
+        )
+        return response
+
+    def get(self, path, **kwargs):
+        if self.cache_size <= 0:
+            return self.request("GET", path, **kwargs)
+
+        url = (
+            requests.Request(
+                "GET", f"{self.base_url}{path}", params=kwargs.get("params")
+            )
+            .prepare()
+            .url
+        )
+        with self._lock:
+            cached = self._cache.get(url)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached is not None:
+            headers["If-None-Match"] = cached.headers["ETag"]
+        try:
+            response = self.request("GET", path, headers=headers, **kwargs)
+        except requests.RequestException:
+            if cached is None:
+                raise
+            # Possibly outdated data is better than none while the service is down
+            with self._lock:
+                self._stats["stale_responses"] += 1
+            return cached
+
+        with self._lock:
+            if response.status_code == 304 and cached is not None:
+                self._stats["not_modified"] += 1
+                self._cache.move_to_end(url)
+                return cached
+            if response.status_code == 200 and "ETag" in response.headers:
+                self._cache[url] = response
+                self._cache.move_to_end(url)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.pop(url, None)
+        return response
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        connection_pools = [pools[key] for key in pools.keys()]
+        opened = sum(pool.num_connections for pool in connection_pools)
+        sent = sum(pool.num_requests for pool in connection_pools)
+        with self._lock:
+            return {
+                "service": self.name,
+                "pool_size": self.pool_size,
+                "connect_timeout": self.timeout[0],
+                "read_timeout": self.timeout[1],
+                "cache_size": self.cache_size,
+                "cached_responses": len(self._cache),
+                "breaker": self.breaker.stats(),
+                **self._stats,
+                "connections_opened": opened,
+                "connections_reused": sent - opened,
+            }
@@ -0,0 +1,78 @@
+"""
+Prometheus metrics of the GUI, served by GET /metrics.
+
+Pages are counted and timed by their URL rule (``/event/<eventid>``), backend calls by
+service, method and status ("error" when no response was received).
+"""
+
+import time
+
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    PlatformCollector,
+    ProcessCollector,
+    generate_latest,
+)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+# A registry of its own, so the GUI can run in one process with the services (as in the
+# endpoint benchmark), whose metrics have the same names
+REGISTRY = CollectorRegistry()
+ProcessCollector(registry=REGISTRY)
+PlatformCollector(registry=REGISTRY)
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests handled",
+    ["method", "route", "status"],
+    registry=REGISTRY,
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, including the backend calls it makes",
+    ["method", "route"],
+    registry=REGISTRY,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled", ["method"], registry=REGISTRY
+)
+BACKEND_DURATION = Histogram(
+    "backend_request_duration_seconds",
+    "Time until the response of a backend service is received",
+    ["service", "method", "status"],
+    registry=REGISTRY,
+)
+
+
+def instrument(app):
+    """Count and time every request of a Flask app."""
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        REQUESTS_IN_PROGRESS.labels(request.method).inc()
+
+    @app.after_request
+    def record_status(response):
+        g.response_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_request(exc):
+        if "request_started" not in g:
+            return
+        duration = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule else UNMATCHED_ROUTE
+        REQUESTS_IN_PROGRESS.labels(request.method).dec()
+        REQUESTS.labels(request.method, route, str(g.get("response_status", 500))).inc()
+        REQUEST_DURATION.labels(request.method, route).observe(duration)
+
+
+def metrics_response():
+    return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
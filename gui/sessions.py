@@ -0,0 +1,20 @@
+import os
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+SESSION_COOKIE = "session"
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 24 * 60 * 60))
+
+# Tokens are issued and signed by the auth service with the same secret, so they can be
+# verified here without asking the auth service
+serializer = URLSafeTimedSerializer(os.environ["SESSION_SECRET"], salt="session")
+
+
+def verify_session_token(token):
+    """The username a session token was issued to, or None if it is invalid or expired."""
+    if not token:
+        return None
+    try:
+        return serializer.loads(token, max_age=SESSION_TTL)["sub"]
+    except (BadSignature, KeyError, TypeError):
+        return None
@@ -0,0 +1,143 @@
+"""
+Tracing of page views, in the format of the services' common/tracing.py.
+
+Every page view starts a trace (its id is sent back in the X-Trace-Id header), every backend
+call is a child span and sends a W3C ``traceparent`` header, so the services record their
+spans in the same trace. Finished spans are written as JSON lines to TRACE_EXPORT (a file, or
+"stdout"); tracing is off when it is not set. ``python -m common.tracing`` in the services
+prints the waterfall of a trace from the files of the GUI and the services.
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, request
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "")
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", 1))
+
+SERVICE_NAME = "gui"
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = sys.stdout if path == "stdout" else open(path, "a", buffering=1)
+
+    def export(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+
+exporter = JsonLinesExporter(TRACE_EXPORT) if TRACE_EXPORT else None
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id, sampled, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if not self.sampled or exporter is None:
+            return
+        exporter.export(
+            {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "service": SERVICE_NAME,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": (time.perf_counter() - self._started) * 1000,
+                "attributes": self.attributes,
+                "error": self.error,
+            }
+        )
+
+
+@contextmanager
+def span(name, **attributes):
+    """A child span of the current span, nothing is recorded outside of a page view."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def traceparent_headers():
+    """Headers that continue the current trace in the service being called."""
+    current = _current_span.get()
+    return {"traceparent": current.traceparent()} if current is not None else {}
+
+
+def trace_requests(app):
+    """Record a trace for every request of a Flask app."""
+    if exporter is None:
+        return
+
+    @app.before_request
+    def start_trace():
+        root = Span(
+            f"{request.method} {request.path}",
+            os.urandom(16).hex(),
+            None,
+            random.random() < TRACE_SAMPLE_RATIO,
+            {"http.method": request.method, "http.target": request.path},
+        )
+        g.trace_span = root
+        g.trace_token = _current_span.set(root)
+
+    @app.after_request
+    def record_status(response):
+        root = g.get("trace_span")
+        if root is not None:
+            root.set("http.status_code", response.status_code)
+            if root.sampled:
+                response.headers["X-Trace-Id"] = root.trace_id
+        return response
+
+    @app.teardown_request
+    def end_trace(exc):
+        root = g.get("trace_span")
+        if root is None:
+            return
+        if request.url_rule is not None:
+            root.name = f"{request.method} {request.url_rule.rule}"
+            root.set("http.route", request.url_rule.rule)
+        if exc is not None:
+            root.error = repr(exc)
+        _current_span.reset(g.trace_token)
+        root.end()
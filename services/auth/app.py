@@ -1,45 +1,114 @@
-from fastapi import FastAPI, HTTPException
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
+import psycopg
+from psycopg.rows import dict_row
+from common.compression import CompressionMiddleware
+from common.db import ConnectionPool, PoolTimeout
+from common.metrics import MetricsMiddleware, metrics_response
+from common.migrations import migrate_database, migrate_on_startup
+from common.responses import JSONResponse
+from common.tracing import TracingMiddleware
+from passwords import HashingPool, HashingBusy, hash_password, needs_rehash
+from sessions import SESSION_TTL, issue_session_token
 from fastapi import FastAPI, Body
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    apply_migrations()
+    open_pool()
+    hashing.start()
+    try:
+        yield
+    finally:
+        close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, service="auth")
+
+
+pool = ConnectionPool("auth")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+hashing = HashingPool()
+DUMMY_HASH = hash_password("")
 
 
 def get_db_connection():
     try:
-        return psycopg2.connect(
-            dbname="auth",
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=os.environ["DATABASE_HOST"],
-            port="5432",
-        )
-    except psycopg2.Error as e:
+        return pool.getconn()
+    except (psycopg.Error, PoolTimeout) as e:
         print("Unable to connect to the database")
         print(e)
         return None
 
 
+def apply_migrations():
+    if not migrate_on_startup():
+        return
+    try:
+        migrate_database("auth", MIGRATIONS_DIR)
+    except psycopg.Error as e:
+        print("Unable to apply the database migrations")
+        print(e)
+        # Without its schema every query of the service fails, so it doesn't start
+        raise
+
+
+def open_pool():
+    try:
+        pool.open()
+    except psycopg.Error as e:
+        print("Unable to open the database pool")
+        print(e)
+
+
+def close_pool():
+    pool.close()
+    hashing.shutdown()
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return metrics_response()
+
+
+@app.get("/pool/stats")
+def pool_stats():
+    return JSONResponse(content=pool.stats(), status_code=200)
+
+
 @app.post("/register/")
 def register(username: str = Body(...), password: str = Body(...)):
+    # Hash before taking a connection, so the connection isn't held while hashing
+    try:
+        password_hash = hashing.hash(password)
+    except HashingBusy as e:
+        return JSONResponse(
+            content={"error": "Failed to register user", "detail": str(e)},
+            status_code=503,
+        )
+
     conn = get_db_connection()
     if conn is None:
         return JSONResponse(
             content={"error": "Unable to connect to the database"}, status_code=500
         )
 
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor(row_factory=dict_row)
     try:
         cur.execute(
             "INSERT INTO auth (username, password) VALUES (%s, %s) RETURNING id;",
-            (username, password),
+            (username, password_hash),
         )
         user_id = cur.fetchone()["id"]
         conn.commit()
-    except psycopg2.Error as e:
+    except psycopg.Error as e:
         conn.rollback()
         return JSONResponse(
             content={"error": "Failed to register user", "detail": str(e)},
@@ -47,10 +116,15 @@ def register(username: str = Body(...), password: str = Body(...)):
         )
     finally:
         cur.close()
-        conn.close()
+        pool.putconn(conn)
 
     return JSONResponse(
-        content={"message": "User registered successfully", "user_id": user_id},
+        content={
+            "message": "User registered successfully",
+            "user_id": user_id,
+            "token": issue_session_token(user_id, username),
+            "expires_in": SESSION_TTL,
+        },
         status_code=201,
     )
 
@@ -63,26 +137,65 @@ def login(username: str = Body(...), password: str = Body(...)):
             content={"error": "Unable to connect to the database"}, status_code=500
         )
 
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur = conn.cursor(row_factory=dict_row)
     try:
         cur.execute(
-            "SELECT id FROM auth WHERE username = %s AND password = %s;",
-            (username, password),
+            "SELECT id, password FROM auth WHERE username = %s;",
+            (username,),
         )
         user = cur.fetchone()
-        if not user:
-            return JSONResponse(
-                content={"error": "Invalid username or password"}, status_code=401
-            )
-    except psycopg2.Error as e:
+    except psycopg.Error as e:
         conn.rollback()
         return JSONResponse(
             content={"error": "Failed to login", "detail": str(e)}, status_code=400
         )
     finally:
         cur.close()
-        conn.close()
+        pool.putconn(conn)
+
+    # Unknown users are checked against a dummy hash so they take as long as a wrong password
+    try:
+        valid = hashing.verify(password, user["password"] if user else DUMMY_HASH)
+    except HashingBusy as e:
+        return JSONResponse(
+            content={"error": "Failed to login", "detail": str(e)}, status_code=503
+        )
+    if not user or not valid:
+        return JSONResponse(
+            content={"error": "Invalid username or password"}, status_code=401
+        )
+
+    if needs_rehash(user["password"]):
+        rehash_password(user["id"], password)
 
     return JSONResponse(
-        content={"message": "Login successful", "user_id": user["id"]}, status_code=200
+        content={
+            "message": "Login successful",
+            "user_id": user["id"],
+            "token": issue_session_token(user["id"], username),
+            "expires_in": SESSION_TTL,
+        },
+        status_code=200,
     )
+
+
+def rehash_password(user_id, password):
+    """Store the password with the current hashing parameters, failures are retried on the next login."""
+    try:
+        password_hash = hashing.hash(password)
+    except HashingBusy:
+        return
+
+    conn = get_db_connection()
+    if conn is None:
+        return
+
+    try:
+        conn.execute(
+            "UPDATE auth SET password = %s WHERE id = %s;", (password_hash, user_id)
+        )
+        conn.commit()
+    except psycopg.Error:
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
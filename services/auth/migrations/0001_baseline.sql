@@ -0,0 +1,6 @@
+-- Schema created by db/init.sql, so databases created without it end up the same
+CREATE TABLE IF NOT EXISTS auth (
+  id SERIAL PRIMARY KEY,
+  username VARCHAR(50) NOT NULL UNIQUE,
+  password VARCHAR(255) NOT NULL
+);
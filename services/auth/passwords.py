@@ -0,0 +1,120 @@
+"""
+Password hashing with scrypt.
+
+Hashes are stored as ``scrypt$<n>$<r>$<p>$<salt>$<hash>`` so the cost parameters can be
+raised later without invalidating existing hashes: a login with an outdated (or plaintext)
+password rehashes it. Hashing is deliberately slow, so it runs on a pool of worker
+processes instead of in the request handler, which lets logins use every core.
+"""
+
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+SCRYPT_N = int(os.environ.get("AUTH_SCRYPT_N", 2**14))
+SCRYPT_R = int(os.environ.get("AUTH_SCRYPT_R", 8))
+SCRYPT_P = int(os.environ.get("AUTH_SCRYPT_P", 1))
+
+HASH_WORKERS = int(os.environ.get("AUTH_HASH_WORKERS", os.cpu_count() or 1))
+# Hashes that may wait for a worker, beyond that requests are rejected instead of queued
+HASH_QUEUE = int(os.environ.get("AUTH_HASH_QUEUE", HASH_WORKERS * 8))
+HASH_TIMEOUT = float(os.environ.get("AUTH_HASH_TIMEOUT", 10))
+
+PREFIX = "scrypt"
+
+# Workers are started by a fork server (or spawned where there is none) instead of forked from
+# the service: a fork of a process with other threads can copy a lock that one of them held,
+# which then stays locked forever in the child
+START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32
+    )
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, n, r, p)
+    return f"{PREFIX}${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+
+
+def verify_password(password, stored):
+    if not stored.startswith(PREFIX + "$"):
+        # Accounts created before passwords were hashed
+        return hmac.compare_digest(password.encode(), stored.encode())
+
+    _, n, r, p, salt, digest = stored.split("$")
+    expected = base64.b64decode(digest)
+    actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(actual, expected)
+
+
+def needs_rehash(stored):
+    return not stored.startswith(f"{PREFIX}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+
+class HashingPool:
+    """Bounded pool of worker processes that hash and verify passwords."""
+
+    def __init__(self, workers=HASH_WORKERS, queue=HASH_QUEUE, timeout=HASH_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context(START_METHOD)
+                if START_METHOD == "forkserver":
+                    context.set_forkserver_preload([__name__])
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=context
+                )
+            return self._executor
+
+    def start(self):
+        """Start every worker process now instead of on the first logins."""
+        executor = self._get_executor()
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashingBusy("Too many passwords are being hashed")
+        try:
+            return self._get_executor().submit(fn, *args).result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingBusy("Hashing the password took too long")
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def verify(self, password, stored):
+        return self.run(verify_password, password, stored)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
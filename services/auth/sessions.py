@@ -0,0 +1,14 @@
+import os
+
+from itsdangerous import URLSafeTimedSerializer
+
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 24 * 60 * 60))
+
+# The GUI verifies tokens with the same secret, so it doesn't need to call this service
+# on every request. The signing time is part of the token, the GUI rejects tokens older
+# than SESSION_TTL.
+serializer = URLSafeTimedSerializer(os.environ["SESSION_SECRET"], salt="session")
+
+
+def issue_session_token(user_id, username):
+    return serializer.dumps({"sub": username, "uid": user_id})
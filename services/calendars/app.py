@@ -1,13 +1,35 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+import asyncio
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Header
+from pydantic import BaseModel
+from common.responses import JSONResponse
+import psycopg
+from psycopg.rows import dict_row
+from common.conditional import read_version
+from common.compression import CompressionMiddleware
+from common.db import AsyncConnectionPool, PoolTimeout
+from common.metrics import MetricsMiddleware, metrics_response
+from common.migrations import migrate_database, migrate_on_startup
+from common.tracing import TracingMiddleware
 from fastapi import FastAPI, Body
 from typing import Optional, List
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app):
+    await apply_migrations()
+    await open_pool()
+    try:
+        yield
+    finally:
+        await close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, service="calendars")
 
 
 class SharedWithUpdate(BaseModel):
@@ -15,74 +37,155 @@ class SharedWithUpdate(BaseModel):
     shared_with: str
 
 
-def get_db_connection():
+pool = AsyncConnectionPool("calendars")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+
+async def get_db_connection():
     try:
-        return psycopg2.connect(
-            dbname="calendars",
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=os.environ["DATABASE_HOST"],
-            port="5432",
-        )
-    except psycopg2.Error as e:
+        return await pool.getconn()
+    except (psycopg.Error, PoolTimeout) as e:
         print("Unable to connect to the database")
         print(e)
         return None
 
 
+async def apply_migrations():
+    if not migrate_on_startup():
+        return
+    try:
+        await asyncio.to_thread(migrate_database, "calendars", MIGRATIONS_DIR)
+    except psycopg.Error as e:
+        print("Unable to apply the database migrations")
+        print(e)
+        # Without its schema every query of the service fails, so it doesn't start
+        raise
+
+
+async def open_pool():
+    try:
+        await pool.open()
+    except psycopg.Error as e:
+        print("Unable to open the database pool")
+        print(e)
+
+
+async def close_pool():
+    await pool.close()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
+
+@app.get("/pool/stats")
+async def pool_stats():
+    return JSONResponse(content=pool.stats(), status_code=200)
+
+
 @app.put("/share")
 async def share_calendar(shared_with_update: SharedWithUpdate):
-    conn = get_db_connection()
+    conn = await get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
 
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(
-                "SELECT * FROM calendars WHERE owner = %s", (shared_with_update.owner,)
+        async with conn.cursor() as cursor:
+            # Sharing a calendar that is already shared with the user does nothing
+            await cursor.execute(
+                "INSERT INTO calendar_shares (owner, shared_with) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                (shared_with_update.owner, shared_with_update.shared_with),
             )
-            owner_record = cursor.fetchone()
-
-            if owner_record:
-                updated_shared_with = owner_record["shared_with"] + [
-                    shared_with_update.shared_with
-                ]
-                cursor.execute(
-                    "UPDATE calendars SET shared_with = %s WHERE owner = %s",
-                    (updated_shared_with, shared_with_update.owner),
-                )
-            else:
-                cursor.execute(
-                    "INSERT INTO calendars (owner, shared_with) VALUES (%s, %s)",
-                    (shared_with_update.owner, [shared_with_update.shared_with]),
-                )
-
-            conn.commit()
+            await conn.commit()
             return JSONResponse(
                 content={"message": "Calendar shared successfully"}, status_code=200
             )
 
     except Exception as e:
-        conn.rollback()
+        await conn.rollback()
         raise HTTPException(
             status_code=500, detail="An error occurred while sharing the calendar"
         )
     finally:
-        conn.close()
+        await pool.putconn(conn)
+
+
+@app.delete("/share")
+async def unshare_calendar(shared_with_update: SharedWithUpdate):
+    conn = await get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    try:
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "DELETE FROM calendar_shares WHERE owner = %s AND shared_with = %s",
+                (shared_with_update.owner, shared_with_update.shared_with),
+            )
+            await conn.commit()
+            return JSONResponse(
+                content={"message": "Calendar unshared successfully"}, status_code=200
+            )
+
+    except Exception as e:
+        await conn.rollback()
+        raise HTTPException(
+            status_code=500, detail="An error occurred while unsharing the calendar"
+        )
+    finally:
+        await pool.putconn(conn)
+
+
+# Check whether the calendar of owner is shared with a user
+@app.get("/share")
+async def is_calendar_shared(
+    owner: str, shared_with: str, if_none_match: Optional[str] = Header(None)
+):
+    conn = await get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    try:
+        version = await read_version(conn, "calendar_shares")
+        if version.matches(if_none_match):
+            return version.not_modified()
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT 1 FROM calendar_shares WHERE owner = %s AND shared_with = %s",
+                (owner, shared_with),
+            )
+            shared = await cursor.fetchone() is not None
+            return version.response(
+                {"owner": owner, "shared_with": shared_with, "shared": shared}
+            )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail="An error occurred while checking the calendar"
+        )
+    finally:
+        await pool.putconn(conn)
 
 
 @app.get("/calendars")
-async def get_calendars(owner: str):
-    conn = get_db_connection()
+async def get_calendars(owner: str, if_none_match: Optional[str] = Header(None)):
+    conn = await get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
 
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM calendars WHERE owner = %s", (owner,))
-            record = cursor.fetchone()
+        version = await read_version(conn, "calendar_shares")
+        if version.matches(if_none_match):
+            return version.not_modified()
+        async with conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(
+                "SELECT owner, array_agg(shared_with ORDER BY shared_with) AS shared_with FROM calendar_shares WHERE owner = %s GROUP BY owner",
+                (owner,),
+            )
+            record = await cursor.fetchone()
             if record:
-                return JSONResponse(content=record, status_code=200)
+                return version.response(record)
             else:
                 return JSONResponse(
                     content={"message": "Calendar not found"}, status_code=404
@@ -92,4 +195,33 @@ async def get_calendars(owner: str):
             status_code=500, detail="An error occurred while getting the calendar"
         )
     finally:
-        conn.close()
+        await pool.putconn(conn)
+
+
+# The owners of the calendars that are shared with a user
+@app.get("/calendars/shared")
+async def get_shared_calendars(
+    shared_with: str, if_none_match: Optional[str] = Header(None)
+):
+    conn = await get_db_connection()
+    if not conn:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+    try:
+        version = await read_version(conn, "calendar_shares")
+        if version.matches(if_none_match):
+            return version.not_modified()
+        async with conn.cursor() as cursor:
+            await cursor.execute(
+                "SELECT owner FROM calendar_shares WHERE shared_with = %s ORDER BY owner",
+                (shared_with,),
+            )
+            owners = [row[0] for row in await cursor.fetchall()]
+            return version.response({"shared_with": shared_with, "owners": owners})
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail="An error occurred while getting the shared calendars",
+        )
+    finally:
+        await pool.putconn(conn)
@@ -0,0 +1,5 @@
+-- Schema created by db/init.sql, so databases created without it end up the same
+CREATE TABLE IF NOT EXISTS calendars (
+    owner VARCHAR(100) PRIMARY KEY,
+    shared_with VARCHAR(100)[] NOT NULL
+);
@@ -0,0 +1,16 @@
+-- One row per share instead of an array per owner, so sharing and unsharing are single
+-- atomic statements, sharing twice is a no-op and both directions can use an index
+CREATE TABLE IF NOT EXISTS calendar_shares (
+    owner VARCHAR(100) NOT NULL,
+    shared_with VARCHAR(100) NOT NULL,
+    PRIMARY KEY (owner, shared_with)
+);
+
+-- Whose calendars are shared with a user
+CREATE INDEX IF NOT EXISTS calendar_shares_shared_with_idx ON calendar_shares (shared_with, owner);
+
+INSERT INTO calendar_shares (owner, shared_with)
+SELECT owner, unnest(shared_with) FROM calendars
+ON CONFLICT DO NOTHING;
+
+DROP TABLE calendars;
@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    In-process LRU cache whose entries also expire ttl seconds after they were stored.
+    Meant to be used from a single event loop, it does no locking.
+
+    generation changes on every invalidation. A caller that computes a value while other
+    tasks run reads it first and passes it to set(), so a value computed before an
+    invalidation isn't stored after it.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.generation = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "stale_sets": 0,
+        }
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, _MISSING)
+        if entry is _MISSING:
+            self._stats["misses"] += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return value
+
+    def set(self, key, value, generation=None):
+        if generation is not None and generation != self.generation:
+            self._stats["stale_sets"] += 1
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, key):
+        self.generation += 1
+        if self._entries.pop(key, _MISSING) is not _MISSING:
+            self._stats["invalidations"] += 1
+
+    def clear(self):
+        self.generation += 1
+        self._stats["invalidations"] += len(self._entries)
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            **self._stats,
+        }
@@ -0,0 +1,163 @@
+"""
+Response compression.
+
+CompressionMiddleware compresses responses of at least RESPONSE_COMPRESS_MIN_SIZE bytes with
+brotli or gzip, whichever the client accepts (brotli is preferred, and only used when the
+brotli package is installed). Streamed responses are compressed chunk by chunk and every
+chunk is flushed, so a client still receives the rows as they are read.
+
+A compressed response is a different representation than the uncompressed one, so its ETag
+is made weak. If-None-Match uses weak comparison, so conditional requests keep working.
+"""
+
+import asyncio
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get("RESPONSE_COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("RESPONSE_GZIP_LEVEL", 3))
+BROTLI_QUALITY = int(os.environ.get("RESPONSE_BROTLI_QUALITY", 4))
+# Bodies this large are compressed on a thread, so the event loop isn't blocked while compressing
+COMPRESS_THREAD_MIN_SIZE = int(
+    os.environ.get("RESPONSE_COMPRESS_THREAD_MIN_SIZE", 256 * 1024)
+)
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    def __init__(self, level=GZIP_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, last):
+        body = self._compressor.compress(data)
+        return body + self._compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        )
+
+
+class BrotliEncoder:
+    name = "br"
+
+    def __init__(self, quality=BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data, last):
+        body = self._compressor.process(data)
+        return body + (self._compressor.finish() if last else self._compressor.flush())
+
+
+def accepted_encodings(accept_encoding):
+    """The content codings a client accepts (q > 0) from its Accept-Encoding header."""
+    accepted = set()
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
+
+def choose_encoder(accept_encoding):
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return BrotliEncoder
+    if "gzip" in accepted or "*" in accepted:
+        return GzipEncoder
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoder_class = choose_encoder(accept_encoding)
+
+        start = None
+        encoder = None
+
+        async def send_compressed(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether to compress
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is not None:
+                headers = [
+                    (name, value)
+                    for name, value in start["headers"]
+                    if name not in (b"content-length", b"vary")
+                ]
+                vary = [value for name, value in start["headers"] if name == b"vary"]
+                already_encoded = any(
+                    name == b"content-encoding" for name, _ in headers
+                )
+                small = not more_body and len(body) < self.minimum_size
+                if encoder_class is None or already_encoded or small:
+                    await send(start)
+                    start = None
+                    await send(message)
+                    return
+
+                encoder = encoder_class()
+                headers = [
+                    (name, weak_etag(value) if name == b"etag" else value)
+                    for name, value in headers
+                ]
+                headers.append((b"content-encoding", encoder.name.encode()))
+                headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+                body = await compress(encoder, body, not more_body)
+                if not more_body:
+                    headers.append((b"content-length", str(len(body)).encode()))
+                await send({**start, "headers": headers})
+                start = None
+                await send(
+                    {"type": "http.response.body", "body": body, "more_body": more_body}
+                )
+                return
+
+            if encoder is not None:
+                body = await compress(encoder, body, not more_body)
+            await send(
+                {"type": "http.response.body", "body": body, "more_body": more_body}
+            )
+
+        await self.app(scope, receive, send_compressed)
+
+
+async def compress(encoder, body, last):
+    if len(body) >= COMPRESS_THREAD_MIN_SIZE:
+        return await asyncio.to_thread(encoder.compress, body, last)
+    return encoder.compress(body, last)
+
+
+def weak_etag(etag):
+    return etag if etag.startswith(b"W/") else b"W/" + etag
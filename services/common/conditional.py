@@ -0,0 +1,62 @@
+"""
+Conditional GET with ETags.
+
+Every database has a ``data_version`` table with a version per table a service reads from,
+bumped by statement triggers on that table (see the migrations), or per value of a column for
+tables that are read by that column (``calendar_entries:<invitee>``). A read looks up the
+version of what it reads and sends it as the ETag of the response, so a request with a matching
+If-None-Match is answered with 304 after one primary key lookup instead of running and
+serializing the whole query. A write only changes the ETags of the responses that read what it
+wrote.
+"""
+
+from datetime import timezone
+from email.utils import format_datetime
+
+from fastapi.responses import Response
+
+from common.responses import JSONResponse
+
+
+class DataVersion:
+    def __init__(self, version, changed_at):
+        self.version = version
+        self.changed_at = changed_at
+
+    @property
+    def etag(self):
+        return f'"{self.version}"'
+
+    def headers(self):
+        headers = {"ETag": self.etag}
+        # Nothing has been written under a name without a row yet
+        if self.changed_at is not None:
+            headers["Last-Modified"] = format_datetime(
+                self.changed_at.astimezone(timezone.utc), usegmt=True
+            )
+        return headers
+
+    def matches(self, if_none_match):
+        """Whether an If-None-Match header matches this version (weak comparison, as RFC 9110 asks)."""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = (tag.strip() for tag in if_none_match.split(","))
+        return any(tag.removeprefix("W/") == self.etag for tag in tags)
+
+    def not_modified(self):
+        return Response(status_code=304, headers=self.headers())
+
+    def response(self, content):
+        return JSONResponse(content=content, status_code=200, headers=self.headers())
+
+
+async def read_version(conn, name):
+    """The current version of a table (or "table:value") in the database of conn, raises psycopg.Error."""
+    async with conn.cursor() as cur:
+        await cur.execute(
+            "SELECT version, changed_at FROM data_version WHERE name = %s", (name,)
+        )
+        row = await cur.fetchone()
+    return DataVersion(*row) if row else DataVersion(0, None)
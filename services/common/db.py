@@ -0,0 +1,435 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg
+from psycopg import pq
+
+from common.metrics import DB_ACQUIRE_DURATION, DB_QUERY_DURATION, current_route, pools
+from common.tracing import query_span
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+def conninfo(dbname):
+    return psycopg.conninfo.make_conninfo(
+        dbname=dbname,
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"],
+        host=os.environ["DATABASE_HOST"],
+        port=os.environ.get("DATABASE_PORT", "5432"),
+    )
+
+
+@contextmanager
+def _instrumented(query, conn):
+    """Time a query for the metrics and record it as a span of the current trace."""
+    start = time.perf_counter()
+    try:
+        with query_span(query, conn):
+            yield
+    finally:
+        DB_QUERY_DURATION.labels(current_route()).observe(time.perf_counter() - start)
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    def execute(self, query, params=None, **kwargs):
+        with _instrumented(query, self.connection):
+            return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        with _instrumented(query, self.connection):
+            return super().executemany(query, params_seq, **kwargs)
+
+
+class InstrumentedAsyncCursor(psycopg.AsyncCursor):
+    async def execute(self, query, params=None, **kwargs):
+        with _instrumented(query, self.connection):
+            return await super().execute(query, params, **kwargs)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        with _instrumented(query, self.connection):
+            return await super().executemany(query, params_seq, **kwargs)
+
+
+class _BasePool:
+    """
+    Bookkeeping shared by the sync and async pools.
+
+    Sizing is read from the environment (DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+    DB_POOL_TIMEOUT, DB_POOL_MAX_USES, DB_POOL_CHECK, DB_POOL_CHECK_IDLE) unless passed
+    explicitly. Only connections that were idle for at least check_idle seconds are checked
+    on checkout, a connection that was just returned is known to work.
+    """
+
+    def __init__(
+        self,
+        dbname,
+        min_size=None,
+        max_size=None,
+        timeout=None,
+        max_uses=None,
+        check=None,
+        check_idle=None,
+    ):
+        self.dbname = dbname
+        self.min_size = (
+            min_size if min_size is not None else _env_int("DB_POOL_MIN_SIZE", 1)
+        )
+        self.max_size = (
+            max_size if max_size is not None else _env_int("DB_POOL_MAX_SIZE", 10)
+        )
+        self.timeout = (
+            timeout if timeout is not None else _env_float("DB_POOL_TIMEOUT", 5.0)
+        )
+        self.max_uses = (
+            max_uses if max_uses is not None else _env_int("DB_POOL_MAX_USES", 1000)
+        )
+        self.check = check if check is not None else _env_bool("DB_POOL_CHECK", True)
+        self.check_idle = (
+            check_idle
+            if check_idle is not None
+            else _env_float("DB_POOL_CHECK_IDLE", 10.0)
+        )
+
+        self._idle = deque()
+        self._uses = {}
+        self._idle_since = {}
+        self._size = 0
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_recycled": 0,
+            "connections_discarded": 0,
+            "failed_checks": 0,
+            "wait_time_total": 0.0,
+        }
+        pools.add(self)
+
+    def _timeout_error(self):
+        self._stats["timeouts"] += 1
+        return PoolTimeout(
+            f"No connection to {self.dbname} available after {self.timeout}s"
+        )
+
+    def _needs_rollback(self, conn):
+        return conn.info.transaction_status != pq.TransactionStatus.IDLE
+
+    def _needs_check(self, conn):
+        if not self.check:
+            return False
+        idle_since = self._idle_since.get(id(conn), 0.0)
+        return time.monotonic() - idle_since >= self.check_idle
+
+    def _should_recycle(self, conn):
+        if self._uses.get(id(conn), 0) >= self.max_uses:
+            self._stats["connections_recycled"] += 1
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "dbname": self.dbname,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._size - len(self._idle),
+            **self._stats,
+        }
+
+
+class ConnectionPool(_BasePool):
+    """Thread-safe pool of blocking connections, for services with sync handlers."""
+
+    def __init__(self, dbname, **kwargs):
+        super().__init__(dbname, **kwargs)
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = psycopg.connect(conninfo(self.dbname), cursor_factory=InstrumentedCursor)
+        with self._cond:
+            self._uses[id(conn)] = 0
+            self._stats["connections_opened"] += 1
+        return conn
+
+    def open(self):
+        """Open connections until min_size is reached."""
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except psycopg.Error:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(conn)
+                self._idle_since[id(conn)] = time.monotonic()
+                self._cond.notify()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self._needs_check(conn):
+            return True
+        try:
+            # A plain cursor, the check isn't a query of the request
+            psycopg.Cursor(conn).execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+    def _drop(self, conn):
+        try:
+            conn.close()
+        except psycopg.Error:
+            pass
+        with self._cond:
+            self._uses.pop(id(conn), None)
+            self._idle_since.pop(id(conn), None)
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool is not full.
+        Raises PoolTimeout when no connection becomes available within the timeout.
+        """
+        start = time.perf_counter()
+        try:
+            return self._getconn()
+        finally:
+            DB_ACQUIRE_DURATION.labels(self.dbname).observe(time.perf_counter() - start)
+
+    def _getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                waited_since = None
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._timeout_error()
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                if waited_since is not None:
+                    self._stats["wait_time_total"] += time.monotonic() - waited_since
+
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except psycopg.Error:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn):
+                with self._cond:
+                    self._stats["failed_checks"] += 1
+                    self._stats["connections_discarded"] += 1
+                self._drop(conn)
+                continue
+
+            with self._cond:
+                self._uses[id(conn)] += 1
+                self._stats["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """Return a connection to the pool, recycling it once it reached max_uses."""
+        if not conn.closed and not discard:
+            try:
+                if self._needs_rollback(conn):
+                    conn.rollback()
+            except psycopg.Error:
+                discard = True
+
+        with self._cond:
+            if conn.closed or discard:
+                self._stats["connections_discarded"] += 1
+            elif not self._should_recycle(conn):
+                self._idle.append(conn)
+                self._idle_since[id(conn)] = time.monotonic()
+                self._cond.notify()
+                return
+        self._drop(conn)
+
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self._drop(conn)
+
+    def stats(self):
+        with self._cond:
+            return super().stats()
+
+
+class AsyncConnectionPool(_BasePool):
+    """
+    Pool of asyncio connections, for services with async handlers. Waiting for a
+    connection or a query suspends only the calling task, never the event loop.
+    """
+
+    def __init__(self, dbname, **kwargs):
+        super().__init__(dbname, **kwargs)
+        self._cond = asyncio.Condition()
+
+    async def _connect(self):
+        conn = await psycopg.AsyncConnection.connect(
+            conninfo(self.dbname), cursor_factory=InstrumentedAsyncCursor
+        )
+        self._uses[id(conn)] = 0
+        self._stats["connections_opened"] += 1
+        return conn
+
+    async def open(self):
+        """Open connections until min_size is reached."""
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                conn = await self._connect()
+            except psycopg.Error:
+                self._size -= 1
+                raise
+            async with self._cond:
+                self._idle.append(conn)
+                self._idle_since[id(conn)] = time.monotonic()
+                self._cond.notify()
+
+    async def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self._needs_check(conn):
+            return True
+        try:
+            # A plain cursor, the check isn't a query of the request
+            await psycopg.AsyncCursor(conn).execute("SELECT 1")
+            await conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+    async def _drop(self, conn):
+        try:
+            await conn.close()
+        except psycopg.Error:
+            pass
+        self._uses.pop(id(conn), None)
+        self._idle_since.pop(id(conn), None)
+        self._size -= 1
+        async with self._cond:
+            self._cond.notify()
+
+    async def getconn(self):
+        """
+        Check a connection out of the pool, opening a new one if the pool is not full.
+        Raises PoolTimeout when no connection becomes available within the timeout.
+        """
+        start = time.perf_counter()
+        try:
+            return await self._getconn()
+        finally:
+            DB_ACQUIRE_DURATION.labels(self.dbname).observe(time.perf_counter() - start)
+
+    async def _getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            async with self._cond:
+                waited_since = None
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise self._timeout_error()
+                    if waited_since is None:
+                        waited_since = time.monotonic()
+                        self._stats["waits"] += 1
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                if waited_since is not None:
+                    self._stats["wait_time_total"] += time.monotonic() - waited_since
+
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = await self._connect()
+                except psycopg.Error:
+                    self._size -= 1
+                    async with self._cond:
+                        self._cond.notify()
+                    raise
+            elif not await self._is_healthy(conn):
+                self._stats["failed_checks"] += 1
+                self._stats["connections_discarded"] += 1
+                await self._drop(conn)
+                continue
+
+            self._uses[id(conn)] += 1
+            self._stats["checkouts"] += 1
+            return conn
+
+    async def putconn(self, conn, discard=False):
+        """Return a connection to the pool, recycling it once it reached max_uses."""
+        if not conn.closed and not discard:
+            try:
+                if self._needs_rollback(conn):
+                    await conn.rollback()
+            except psycopg.Error:
+                discard = True
+
+        if conn.closed or discard:
+            self._stats["connections_discarded"] += 1
+        elif not self._should_recycle(conn):
+            async with self._cond:
+                self._idle.append(conn)
+                self._idle_since[id(conn)] = time.monotonic()
+                self._cond.notify()
+            return
+        await self._drop(conn)
+
+    async def close(self):
+        idle = list(self._idle)
+        self._idle.clear()
+        for conn in idle:
+            await self._drop(conn)
@@ -0,0 +1,151 @@
+"""
+Prometheus metrics, served by GET /metrics on every service.
+
+MetricsMiddleware counts and times every request by route template (``/invitations/{event_id}/{invitee}``
+rather than the path, which keeps the number of series bounded) and tracks the requests in
+progress. The connection pools time every checkout and every query, which is labelled with
+the route that ran it.
+"""
+
+import time
+import weakref
+from contextvars import ContextVar
+
+from fastapi.responses import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# Requests that didn't match any route, so a scan of random paths doesn't create a series per path
+UNMATCHED_ROUTE = "<unmatched>"
+
+DB_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+
+REQUESTS = Counter(
+    "http_requests_total", "Requests handled", ["method", "route", "status"]
+)
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request until the last byte of its response is sent",
+    ["method", "route"],
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "http_requests_in_progress", "Requests being handled", ["method"]
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Time to execute a query and receive its result",
+    ["route"],
+    buckets=DB_BUCKETS,
+)
+DB_ACQUIRE_DURATION = Histogram(
+    "db_pool_acquire_duration_seconds",
+    "Time to check a connection out of the pool, including waiting for one and its health check",
+    ["dbname"],
+    buckets=DB_BUCKETS,
+)
+
+# The ASGI scope of the request being handled, the router adds the matched route to it
+_request_scope = ContextVar("request_scope", default=None)
+
+
+def current_route():
+    """Route template of the request being handled, empty outside of a request."""
+    scope = _request_scope.get()
+    if scope is None:
+        return ""
+    route = scope.get("route")
+    return getattr(route, "path", UNMATCHED_ROUTE)
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _request_scope.set(scope)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - start
+            in_progress.dec()
+            _request_scope.reset(token)
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            REQUESTS.labels(method, route, str(status)).inc()
+            REQUEST_DURATION.labels(method, route).observe(duration)
+
+
+class PoolCollector:
+    """Size and counters of the connection pools, read from pool.stats() on every scrape."""
+
+    def __init__(self):
+        self._pools = weakref.WeakSet()
+
+    def add(self, pool):
+        self._pools.add(pool)
+
+    def collect(self):
+        connections = GaugeMetricFamily(
+            "db_pool_connections", "Open connections", labels=["dbname", "state"]
+        )
+        max_size = GaugeMetricFamily(
+            "db_pool_max_size", "Maximum number of connections", labels=["dbname"]
+        )
+        timeouts = CounterMetricFamily(
+            "db_pool_timeouts",
+            "Checkouts that failed because no connection became available",
+            labels=["dbname"],
+        )
+        for pool in list(self._pools):
+            stats = pool.stats()
+            connections.add_metric([stats["dbname"], "idle"], stats["idle"])
+            connections.add_metric([stats["dbname"], "in_use"], stats["in_use"])
+            max_size.add_metric([stats["dbname"]], stats["max_size"])
+            timeouts.add_metric([stats["dbname"]], stats["timeouts"])
+        yield connections
+        yield max_size
+        yield timeouts
+
+
+pools = PoolCollector()
+REGISTRY.register(pools)
+
+
+def metrics_response():
+    return Response(content=generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
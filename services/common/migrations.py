@@ -0,0 +1,213 @@
+"""
+Versioned schema migrations.
+
+Every service keeps its migrations as numbered SQL files (``0002_add_indexes.sql``) in
+its ``migrations`` directory. Each file is applied once, in order, in its own transaction,
+and recorded in the ``schema_migrations`` table. A migration whose first line is
+``-- migrate: no-transaction`` is applied one statement at a time outside of a transaction
+instead, for statements that can't run in one (CREATE INDEX CONCURRENTLY) or that commit as
+they go (a backfill in batches); its statements must be safe to run again, in case it is
+interrupted. Migrations are applied when a service starts (unless DB_MIGRATE_ON_STARTUP is
+false), which waits up to DB_MIGRATE_TIMEOUT seconds for the database to accept connections
+and fails the startup if they can't be applied, or from the command line:
+
+    python -m common.migrations <dbname> <migrations directory> [--list]
+"""
+
+import argparse
+import os
+import re
+import time
+
+import psycopg
+
+from common.db import conninfo
+
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# Held while migrating, so replicas that start at the same time don't apply a migration twice
+MIGRATION_LOCK = 7270601
+LOCK_POLL_INTERVAL = 1.0
+
+# Backoff between connection attempts while the database is starting
+CONNECT_RETRY_DELAY = 0.5
+MAX_CONNECT_RETRY_DELAY = 5.0
+
+NO_TRANSACTION = "-- migrate: no-transaction"
+
+
+def migrate_on_startup():
+    return os.environ.get("DB_MIGRATE_ON_STARTUP", "true").lower() in (
+        "1",
+        "true",
+        "yes",
+        "on",
+    )
+
+
+def load_migrations(directory):
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append(
+                (int(match.group(1)), match.group(2), os.path.join(directory, filename))
+            )
+    return sorted(migrations)
+
+
+def applied_versions(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INT PRIMARY KEY, "
+        "name VARCHAR(100) NOT NULL, "
+        "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+    )
+    rows = conn.execute("SELECT version FROM schema_migrations").fetchall()
+    conn.commit()
+    return {row[0] for row in rows}
+
+
+def split_statements(sql):
+    """The statements of a script, split on the semicolons outside of quotes and comments."""
+    statements = []
+    start = 0
+    has_code = False
+    i = 0
+    while i < len(sql):
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end + 1
+            continue
+        if sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = len(sql) if end == -1 else end + 2
+            continue
+        char = sql[i]
+        if char in ("'", '"'):
+            end = sql.find(char, i + 1)
+            i = len(sql) if end == -1 else end + 1
+            has_code = True
+            continue
+        dollar = re.match(r"\$(\w*)\$", sql[i:]) if char == "$" else None
+        if dollar:
+            end = sql.find(dollar.group(0), i + len(dollar.group(0)))
+            i = len(sql) if end == -1 else end + len(dollar.group(0))
+            has_code = True
+            continue
+        if char == ";":
+            if has_code:
+                statements.append(sql[start:i].strip())
+            start = i + 1
+            has_code = False
+        elif not char.isspace():
+            has_code = True
+        i += 1
+    if has_code:
+        statements.append(sql[start:].strip())
+    return statements
+
+
+def acquire_lock(conn):
+    # Polled rather than waited for, a replica waiting in pg_advisory_lock would hold a snapshot
+    # that CREATE INDEX CONCURRENTLY in the replica that is migrating waits for
+    while True:
+        locked = conn.execute(
+            "SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK,)
+        ).fetchone()[0]
+        conn.commit()
+        if locked:
+            return
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def apply_migration(conn, version, name, sql):
+    if sql.startswith(NO_TRANSACTION):
+        conn.autocommit = True
+        try:
+            for statement in split_statements(sql):
+                conn.execute(statement)
+        finally:
+            conn.autocommit = False
+        with conn.transaction():
+            record_migration(conn, version, name)
+        return
+
+    with conn.transaction():
+        conn.execute(sql)
+        record_migration(conn, version, name)
+
+
+def record_migration(conn, version, name):
+    conn.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+        (version, name),
+    )
+
+
+def migrate(conn, directory):
+    """Apply the migrations in directory that haven't been applied yet, returns their versions."""
+    acquire_lock(conn)
+    try:
+        done = applied_versions(conn)
+        applied = []
+        for version, name, path in load_migrations(directory):
+            if version in done:
+                continue
+            with open(path) as f:
+                sql = f.read()
+            apply_migration(conn, version, name, sql)
+            applied.append(version)
+        return applied
+    finally:
+        conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+        conn.commit()
+
+
+def connect(dbname, timeout):
+    """Connect to dbname, retrying with backoff for up to timeout seconds while it is starting."""
+    deadline = time.monotonic() + timeout
+    delay = CONNECT_RETRY_DELAY
+    while True:
+        try:
+            return psycopg.connect(conninfo(dbname))
+        except psycopg.OperationalError as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise
+            print(
+                f"Database {dbname} is not available yet, retrying in {delay:g}s: {e}"
+            )
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MAX_CONNECT_RETRY_DELAY)
+
+
+def migrate_database(dbname, directory, timeout=None):
+    if timeout is None:
+        timeout = float(os.environ.get("DB_MIGRATE_TIMEOUT", 60))
+    with connect(dbname, timeout) as conn:
+        return migrate(conn, directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply schema migrations")
+    parser.add_argument("dbname")
+    parser.add_argument("directory")
+    parser.add_argument(
+        "--list", action="store_true", help="only show which migrations are applied"
+    )
+    args = parser.parse_args()
+
+    if args.list:
+        with psycopg.connect(conninfo(args.dbname)) as conn:
+            done = applied_versions(conn)
+        for version, name, _ in load_migrations(args.directory):
+            print(f"[{'x' if version in done else ' '}] {version:04d} {name}")
+        return
+
+    applied = migrate_database(args.dbname, args.directory)
+    print(f"Applied {len(applied)} migration(s) to {args.dbname}: {applied}")
+
+
+if __name__ == "__main__":
+    main()
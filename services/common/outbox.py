@@ -0,0 +1,131 @@
+"""
+Transactional outbox and change feed.
+
+Services record every change in an ``outbox`` table in the same transaction as the write
+itself, so a change is published if and only if it was committed. The table has a trigger
+that sends a NOTIFY on the ``outbox`` channel, which wakes up long-polling readers.
+
+Outbox ids are allocated before commit, so a transaction can commit a lower id after a
+higher one is already visible. The feed is therefore ordered by (transaction id, id) and
+only returns changes of transactions older than every transaction still in progress: a
+change that is returned can never be followed by one that sorts before it.
+"""
+
+import asyncio
+import os
+
+import psycopg
+from psycopg.rows import dict_row
+
+from common.db import conninfo
+from common.pagination import encode_cursor, decode_cursor
+
+OUTBOX_CHANNEL = "outbox"
+
+DEFAULT_CHANGES_LIMIT = 100
+MAX_CHANGES_LIMIT = 1000
+MAX_CHANGES_WAIT = 30
+
+# How often a long poll checks for changes when no notification arrives
+CHANGES_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", 1))
+
+SELECT_CHANGES = (
+    "SELECT id, txid::text AS txid, type, payload, "
+    "TO_CHAR(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD\"T\"HH24:MI:SS.US\"Z\"') AS created_at "
+    "FROM outbox WHERE txid < pg_snapshot_xmin(pg_current_snapshot())"
+)
+
+
+class ChangeFeed:
+    """
+    Reads the outbox of a database. While started it listens for notifications so
+    long polls return as soon as a change is committed.
+    """
+
+    def __init__(self, pool, dbname):
+        self.pool = pool
+        self.dbname = dbname
+        self._changed = asyncio.Condition()
+        self._listener = None
+
+    async def start(self):
+        if self._listener is None:
+            self._listener = asyncio.ensure_future(self._listen())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    async def _listen(self):
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    conninfo(self.dbname), autocommit=True
+                ) as conn:
+                    await conn.execute(f"LISTEN {OUTBOX_CHANNEL}")
+                    async for _ in conn.notifies():
+                        async with self._changed:
+                            self._changed.notify_all()
+            except psycopg.Error as e:
+                # Long polls fall back to polling until the listener is back
+                print("Unable to listen for outbox notifications")
+                print(e)
+                await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+    async def _wait(self, timeout):
+        async with self._changed:
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def read(self, cursor=None, limit=DEFAULT_CHANGES_LIMIT, wait=0):
+        """
+        The changes after cursor (all changes if it is None), together with the cursor to pass
+        to get the next changes. With wait, waits up to that many seconds for a change if there
+        are none yet. Raises ValueError for an invalid cursor.
+        """
+        after = decode_cursor(cursor, 2) if cursor is not None else None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            changes = await self._select(after, limit)
+            remaining = deadline - loop.time()
+            if changes or remaining <= 0:
+                break
+            await self._wait(min(remaining, CHANGES_POLL_INTERVAL))
+
+        if changes:
+            cursor = encode_cursor(changes[-1]["txid"], changes[-1]["id"])
+        for change in changes:
+            del change["txid"]
+        return {"changes": changes, "next_cursor": cursor}
+
+    async def _select(self, after, limit):
+        query = SELECT_CHANGES
+        params = []
+        if after is not None:
+            query += " AND (outbox.txid, outbox.id) > (%s::xid8, %s)"
+            params.extend(after)
+        # Qualified, a plain txid would sort by the text column of the select list
+        query += " ORDER BY outbox.txid, outbox.id LIMIT %s"
+        params.append(limit)
+
+        conn = await self.pool.getconn()
+        try:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(query, params)
+                rows = await cur.fetchall()
+            # Ends the transaction, the next poll needs a new snapshot
+            await conn.commit()
+            return rows
+        except psycopg.Error:
+            await conn.rollback()
+            raise
+        finally:
+            await self.pool.putconn(conn)
@@ -0,0 +1,18 @@
+import base64
+import json
+
+
+def encode_cursor(*values):
+    """Opaque cursor for keyset pagination, holding the sort key of the last row of a page."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    """Sort key stored in a cursor, raises ValueError if it isn't a cursor of this size."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
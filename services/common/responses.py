@@ -0,0 +1,36 @@
+import json
+
+from fastapi import responses
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content):
+    """Encode content as compact UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class JSONResponse(responses.JSONResponse):
+    """JSONResponse that encodes with orjson, which is several times faster than the json module for large lists of rows."""
+
+    def render(self, content):
+        return dumps(content)
+
+
+class QueryError(Exception):
+    """Raised by query helpers of a handler, carries the error response to return."""
+
+    def __init__(self, content, status_code):
+        super().__init__(content)
+        self.content = content
+        self.status_code = status_code
+
+    def response(self):
+        return JSONResponse(content=self.content, status_code=self.status_code)
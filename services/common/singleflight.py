@@ -0,0 +1,34 @@
+import asyncio
+
+
+def query_key(query, params):
+    """Hashable key for a query and its parameters (list parameters become tuples)."""
+    return (query, tuple(tuple(p) if isinstance(p, list) else p for p in params))
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: while a call for a key is in
+    flight, later callers wait for it and get its result (or exception) instead of making
+    their own call. Meant to be used from a single event loop.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            self._stats["calls"] += 1
+            # The call runs as its own task so a caller that is cancelled (e.g. the
+            # client disconnected) doesn't cancel it for the others that are waiting
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self._stats["shared"] += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {"in_flight": len(self._calls), **self._stats}
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import uuid
+
+from fastapi.responses import StreamingResponse
+from psycopg.rows import dict_row
+
+from common.responses import JSONResponse, dumps
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+STREAM_CHUNK_SIZE = int(os.environ.get("DB_STREAM_CHUNK_SIZE", 1000))
+
+
+class RowStreams:
+    """
+    NDJSON exports of query results, read from a pool. A stream holds its connection until
+    the last row is sent, so at most max_streams (DB_MAX_STREAMS, default half the pool) run
+    at a time and slow clients can't take every connection of the pool.
+    """
+
+    def __init__(self, pool, max_streams=None):
+        self.pool = pool
+        self.max_streams = (
+            max_streams
+            if max_streams is not None
+            else int(os.environ.get("DB_MAX_STREAMS", max(1, pool.max_size // 2)))
+        )
+        self._slots = asyncio.Semaphore(self.max_streams)
+
+    def response(self, query, params):
+        """A response streaming the rows of query, or a 503 when max_streams are running."""
+        if self._slots.locked():
+            return JSONResponse(
+                content={"error": "Too many streams in progress, try again later"},
+                status_code=503,
+                headers={"Retry-After": "1"},
+            )
+        return StreamingResponse(self.rows(query, params), media_type=NDJSON_MEDIA_TYPE)
+
+    async def rows(self, query, params, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Yield the rows of query as NDJSON, one chunk of rows at a time. The rows are read
+        through a server-side cursor so at most one chunk is held in memory. The slot and
+        the connection are only taken once the response is sent, a response that is never
+        sent (the client disconnected first) holds neither.
+        """
+        async with self._slots:
+            conn = await self.pool.getconn()
+            try:
+                async with conn.cursor(
+                    name=f"stream_{uuid.uuid4().hex}", row_factory=dict_row
+                ) as cur:
+                    await cur.execute(query, params)
+                    while True:
+                        rows = await cur.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        yield b"".join(dumps(row) + b"\n" for row in rows)
+            finally:
+                await self.pool.putconn(conn)
@@ -0,0 +1,306 @@
+"""
+Request tracing with W3C trace context.
+
+TracingMiddleware continues the trace of the ``traceparent`` header of a request (the GUI
+sends one with every backend call) or starts a new one, and records a span around the
+handler. Within a request span() records child spans, the connection pools record one for
+every query. Finished spans are written as JSON lines to TRACE_EXPORT (a file, or "stdout");
+tracing is off when it is not set.
+
+The spans of a page view are spread over the files of the GUI and the services, this
+module prints them as a waterfall:
+
+    python -m common.tracing gui.jsonl events.jsonl invitations.jsonl calendars.jsonl
+    python -m common.tracing *.jsonl --trace <trace id>
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "")
+# Fraction of the traces started here that are recorded, a trace started by a caller is
+# recorded if the caller recorded it
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", 1))
+# Longer statements are truncated in the db.statement attribute of query spans
+MAX_STATEMENT_LENGTH = 1000
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = sys.stdout if path == "stdout" else open(path, "a", buffering=1)
+
+    def export(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+
+exporter = JsonLinesExporter(TRACE_EXPORT) if TRACE_EXPORT else None
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, service, trace_id, parent_id, sampled, attributes=None):
+        self.name = name
+        self.service = service
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if not self.sampled or exporter is None:
+            return
+        exporter.export(
+            {
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "service": self.service,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": (time.perf_counter() - self._started) * 1000,
+                "attributes": self.attributes,
+                "error": self.error,
+            }
+        )
+
+
+def parse_traceparent(header):
+    """(trace_id, parent_id, sampled) of a traceparent header, None if it isn't valid."""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) < 4 or len(parts[0]) != 2 or parts[0] == "ff":
+        return None
+    _, trace_id, parent_id, flags = parts[:4]
+    if len(trace_id) != 32 or len(parent_id) != 16 or len(flags) != 2:
+        return None
+    try:
+        int(trace_id, 16), int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except ValueError:
+        return None
+    if trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, sampled
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextmanager
+def _activate(span):
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+@contextmanager
+def trace(name, service, traceparent=None, **attributes):
+    """A span that continues the trace of a traceparent header, or starts a new trace."""
+    if exporter is None:
+        yield None
+        return
+    parent = parse_traceparent(traceparent)
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id = os.urandom(16).hex(), None
+        sampled = random.random() < TRACE_SAMPLE_RATIO
+    with _activate(
+        Span(name, service, trace_id, parent_id, sampled, attributes)
+    ) as root:
+        yield root
+
+
+@contextmanager
+def span(name, **attributes):
+    """A child span of the current span, nothing is recorded outside of a trace."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _activate(
+        Span(
+            name,
+            parent.service,
+            parent.trace_id,
+            parent.span_id,
+            parent.sampled,
+            attributes,
+        )
+    ) as child:
+        yield child
+
+
+def traceparent_headers():
+    """Headers that continue the current trace in the service being called."""
+    current = _current_span.get()
+    return {"traceparent": current.traceparent()} if current is not None else {}
+
+
+def query_span(query, conn):
+    """A span for a query on conn, the statement is only rendered when the query is traced."""
+    current = _current_span.get()
+    if current is None or not current.sampled:
+        return nullcontext()
+    return span(
+        "query",
+        **{"db.name": conn.info.dbname, "db.statement": statement_text(query, conn)},
+    )
+
+
+def statement_text(query, conn):
+    if isinstance(query, bytes):
+        text = query.decode("utf-8", "replace")
+    elif isinstance(query, str):
+        text = query
+    else:
+        text = query.as_string(conn)
+    text = " ".join(text.split())
+    return text[:MAX_STATEMENT_LENGTH]
+
+
+class TracingMiddleware:
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or exporter is None:
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                request_span.set("http.status_code", message["status"])
+            await send(message)
+
+        with trace(
+            scope["method"],
+            self.service,
+            traceparent,
+            **{"http.method": scope["method"], "http.target": scope["path"]},
+        ) as request_span:
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                if route is not None:
+                    request_span.name = f"{scope['method']} {route}"
+                    request_span.set("http.route", route)
+
+
+def read_spans(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+    return spans
+
+
+def print_waterfall(spans, width=40):
+    """Print the spans of one trace as a tree, with a bar showing when each one ran."""
+    by_id = {s["span_id"]: s for s in spans}
+    children = {}
+    roots = []
+    for s in sorted(spans, key=lambda s: s["start"]):
+        if s["parent_id"] in by_id:
+            children.setdefault(s["parent_id"], []).append(s)
+        else:
+            roots.append(s)
+
+    start = min(s["start"] for s in spans)
+    end = max(s["start"] + s["duration_ms"] / 1000 for s in spans)
+    total = max(end - start, 1e-9)
+
+    def show(s, depth):
+        offset = s["start"] - start
+        left = int(offset / total * width)
+        length = max(1, int(s["duration_ms"] / 1000 / total * width))
+        bar = " " * left + "#" * min(length, width - left)
+        label = f"{'  ' * depth}{s['service']}: {s['name']}"
+        if "db.statement" in s["attributes"]:
+            label += f"  {s['attributes']['db.statement'][:60]}"
+        if s["error"]:
+            label += f"  ERROR {s['error']}"
+        print(
+            f"{offset * 1000:>9.1f} {s['duration_ms']:>9.1f}  |{bar:<{width}}|  {label}"
+        )
+        for child in children.get(s["span_id"], []):
+            show(child, depth + 1)
+
+    print(f"{'start ms':>9} {'ms':>9}  |{'':<{width}}|")
+    for root in roots:
+        show(root, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show recorded traces")
+    parser.add_argument(
+        "files", nargs="+", help="JSON lines files written by TRACE_EXPORT"
+    )
+    parser.add_argument("--trace", help="print the waterfall of this trace")
+    parser.add_argument(
+        "--slowest", type=int, default=20, help="number of traces to list"
+    )
+    args = parser.parse_args()
+
+    traces = {}
+    for s in read_spans(args.files):
+        traces.setdefault(s["trace_id"], []).append(s)
+
+    if args.trace:
+        if args.trace not in traces:
+            sys.exit(f"Trace {args.trace} not found")
+        print_waterfall(traces[args.trace])
+        return
+
+    # The slowest traces, by the duration of their first span (the page view or request)
+    summaries = []
+    for trace_id, spans in traces.items():
+        root = min(spans, key=lambda s: s["start"])
+        summaries.append((root["duration_ms"], trace_id, root, len(spans)))
+    summaries.sort(reverse=True, key=lambda summary: summary[0])
+    print(f"{'trace':<32} {'ms':>9} {'spans':>6}  root")
+    for duration, trace_id, root, count in summaries[: args.slowest]:
+        print(
+            f"{trace_id:<32} {duration:>9.1f} {count:>6}  {root['service']}: {root['name']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,46 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+import asyncio
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import FastAPI, HTTPException, Query, Header
+from pydantic import BaseModel
+import psycopg
+from psycopg.rows import dict_row
+from common.cache import TTLCache
+from common.conditional import read_version
+from common.compression import CompressionMiddleware
+from common.db import AsyncConnectionPool, PoolTimeout
+from common.metrics import MetricsMiddleware, metrics_response
+from common.migrations import migrate_database, migrate_on_startup
+from common.outbox import (
+    ChangeFeed,
+    DEFAULT_CHANGES_LIMIT,
+    MAX_CHANGES_LIMIT,
+    MAX_CHANGES_WAIT,
+)
+from common.pagination import encode_cursor, decode_cursor
+from common.responses import JSONResponse, QueryError
+from common.singleflight import SingleFlight, query_key
+from common.streaming import RowStreams
+from common.tracing import TracingMiddleware
 from fastapi import FastAPI, Body
-from typing import Optional
+from typing import Optional, List, Literal
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await apply_migrations()
+    await open_pool()
+    try:
+        yield
+    finally:
+        await close_pool()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, service="events")
 
 
 class Event(BaseModel):
@@ -18,24 +51,100 @@ class Event(BaseModel):
     is_public: bool
 
 
-def get_db_connection():
+class EventLookup(BaseModel):
+    ids: List[int]
+    is_public: Optional[bool] = None
+
+
+pool = AsyncConnectionPool("events")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Events by id, and the responses of event listings (e.g. the public events on the homepage)
+# per data version. Writes in this process invalidate the events and drop the listings of
+# older versions, the TTL bounds how long other replicas serve stale events.
+event_cache = TTLCache(
+    maxsize=int(os.environ.get("EVENTS_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("EVENTS_CACHE_TTL", 60)),
+)
+listing_cache = TTLCache(
+    maxsize=int(os.environ.get("EVENTS_LISTING_CACHE_SIZE", 256)),
+    ttl=float(os.environ.get("EVENTS_LISTING_CACHE_TTL", 5)),
+)
+
+# Concurrent identical queries (e.g. cache misses for a popular event) run only once
+flights = SingleFlight()
+
+changes = ChangeFeed(pool, "events")
+
+# Exports with stream=true, each holds a connection until it is sent
+streams = RowStreams(pool)
+
+
+async def get_db_connection():
     try:
-        return psycopg2.connect(
-            dbname="events",
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=os.environ["DATABASE_HOST"],
-            port="5432",
-        )
-    except psycopg2.Error as e:
+        return await pool.getconn()
+    except (psycopg.Error, PoolTimeout) as e:
         print("Unable to connect to the database")
         print(e)
         return None
 
 
+async def apply_migrations():
+    if not migrate_on_startup():
+        return
+    try:
+        await asyncio.to_thread(migrate_database, "events", MIGRATIONS_DIR)
+    except psycopg.Error as e:
+        print("Unable to apply the database migrations")
+        print(e)
+        # Without its schema every query of the service fails, so it doesn't start
+        raise
+
+
+async def open_pool():
+    try:
+        await pool.open()
+    except psycopg.Error as e:
+        print("Unable to open the database pool")
+        print(e)
+    await changes.start()
+
+
+async def close_pool():
+    await changes.stop()
+    await pool.close()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
+
+@app.get("/pool/stats")
+async def pool_stats():
+    return JSONResponse(content=pool.stats(), status_code=200)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return JSONResponse(
+        content={"events": event_cache.stats(), "listings": listing_cache.stats()},
+        status_code=200,
+    )
+
+
+@app.get("/single-flight/stats")
+async def single_flight_stats():
+    return JSONResponse(content=flights.stats(), status_code=200)
+
+
 @app.post("/events/")
 async def create_event(event: Event):
-    conn = get_db_connection()
+    conn = await get_db_connection()
     if conn is None:
         return JSONResponse(
             content={"error": "Unable to connect to the database"}, status_code=500
@@ -43,8 +152,15 @@ async def create_event(event: Event):
 
     cur = conn.cursor()
     try:
-        cur.execute(
-            "INSERT INTO events (date, organizer, title, description, is_public) VALUES (%s, %s, %s, %s, %s) RETURNING id;",
+        await cur.execute(
+            # The event and its change in the outbox are written by one statement
+            "WITH created AS ("
+            "INSERT INTO events (date, organizer, title, description, is_public) VALUES (%s, %s, %s, %s, %s) "
+            "RETURNING id, date, organizer, title, description, is_public), "
+            "recorded AS (INSERT INTO outbox (type, payload) SELECT 'event.created', jsonb_build_object("
+            "'id', id, 'date', TO_CHAR(date, 'YYYY-MM-DD'), 'organizer', organizer, 'title', title, "
+            "'description', description, 'is_public', is_public) FROM created) "
+            "SELECT id FROM created;",
             (
                 event.date,
                 event.organizer,
@@ -53,33 +169,34 @@ async def create_event(event: Event):
                 event.is_public,
             ),
         )
-        event_id = cur.fetchone()[0]
-        conn.commit()
+        event_id = (await cur.fetchone())[0]
+        await conn.commit()
+        invalidate_event(event_id)
         return JSONResponse(
             content={"message": "Event created successfully", "event_id": event_id},
             status_code=201,
         )
-    except psycopg2.Error as error:
-        conn.rollback()
+    except psycopg.Error as error:
+        await conn.rollback()
         return JSONResponse(
             content={"error": "Failed to create event", "detail": str(error)},
             status_code=400,
         )
     finally:
-        cur.close()
-        conn.close()
+        await cur.close()
+        await pool.putconn(conn)
 
 
-@app.get("/events/")
-async def get_events(
-    is_public: Optional[bool] = Query(None), id: Optional[int] = Query(None)
+def build_events_query(
+    is_public=None,
+    ids=None,
+    date_from=None,
+    date_to=None,
+    organizer=None,
+    after=None,
+    limit=None,
+    descending=False,
 ):
-    conn = get_db_connection()
-    if conn is None:
-        return JSONResponse(
-            content={"error": "Unable to connect to the database"}, status_code=500
-        )
-
     query = "SELECT id, TO_CHAR(date, 'YYYY-MM-DD') as date, organizer, title, description, is_public FROM events"
     params = []
     conditions = []
@@ -88,24 +205,355 @@ async def get_events(
         conditions.append("is_public = %s")
         params.append(is_public)
 
-    if id is not None:
-        conditions.append("id = %s")
-        params.append(id)
+    if ids is not None:
+        conditions.append("id = ANY(%s)")
+        params.append(list(ids))
+
+    if date_from is not None:
+        conditions.append("date >= %s")
+        params.append(date_from)
+
+    if date_to is not None:
+        conditions.append("date <= %s")
+        params.append(date_to)
+
+    if organizer is not None:
+        conditions.append("organizer = %s")
+        params.append(organizer)
+
+    if after is not None:
+        if descending:
+            conditions.append("(date, id) < (%s::date, %s)")
+        else:
+            conditions.append("(date, id) > (%s::date, %s)")
+        params.extend(after)
 
     if conditions:
         query += " WHERE " + " AND ".join(conditions)
 
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    # events.date, a bare date would be the YYYY-MM-DD text of the select list, which no
+    # index is sorted by
+    if descending:
+        query += " ORDER BY events.date DESC, id DESC"
+    elif limit is not None or date_from is not None or date_to is not None:
+        query += " ORDER BY events.date, id"
+
+    if limit is not None:
+        # Fetch one extra row to know whether there is a next page
+        query += " LIMIT %s"
+        params.append(limit + 1)
+
+    return query, tuple(params)
+
+
+async def select_events(query, params, version):
+    # Identical queries that arrive while one is running share its result. Only requests
+    # that read the same version share a query: a query that started before a write must
+    # not be answered with the version after it, clients would keep its result for good
+    return await flights.do(
+        (version.version, query_key(query, params)),
+        lambda: run_events_query(query, params),
+    )
+
+
+async def run_events_query(query, params):
+    conn = await get_db_connection()
+    if conn is None:
+        raise QueryError({"error": "Unable to connect to the database"}, 500)
+
+    cur = conn.cursor(row_factory=dict_row)
     try:
-        cur.execute(query, tuple(params))
-        events = cur.fetchall()
-        return JSONResponse(content={"events": events}, status_code=200)
-    except psycopg2.Error as error:
-        conn.rollback()
+        await cur.execute(query, params)
+        return await cur.fetchall()
+    except psycopg.Error as error:
+        await conn.rollback()
+        raise QueryError({"error": "Failed to fetch events", "detail": str(error)}, 400)
+    finally:
+        await cur.close()
+        await pool.putconn(conn)
+
+
+async def current_version():
+    conn = await get_db_connection()
+    if conn is None:
+        raise QueryError({"error": "Unable to connect to the database"}, 500)
+
+    try:
+        return await read_version(conn, "events")
+    except psycopg.Error as error:
+        raise QueryError(
+            {"error": "Failed to fetch the data version", "detail": str(error)}, 500
+        )
+    finally:
+        await pool.putconn(conn)
+
+
+async def lookup_events_by_id(ids, version, is_public=None):
+    """
+    Events with the given ids as of version, only the ones that aren't cached are read from
+    the database. Events are only ever inserted, so a cached event is never older than version.
+    """
+    events = {}
+    missing = []
+    for event_id in dict.fromkeys(ids):
+        event = event_cache.get(event_id)
+        if event is None:
+            missing.append(event_id)
+        else:
+            events[event_id] = event
+
+    if missing:
+        generation = event_cache.generation
+        for event in await select_events(*build_events_query(ids=missing), version):
+            event_cache.set(event["id"], event, generation)
+            events[event["id"]] = event
+
+    return [
+        event
+        for event in events.values()
+        if is_public is None or event["is_public"] == is_public
+    ]
+
+
+async def list_events(version, after=None, limit=None, descending=False, **filters):
+    events = await select_events(
+        *build_events_query(after=after, limit=limit, descending=descending, **filters),
+        version,
+    )
+    if limit is None:
+        return {"events": events}
+
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1]["date"], events[-1]["id"])
+    return {"events": events, "next_cursor": next_cursor}
+
+
+def build_search_query(text, is_public=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    # Ranks are real (float4) so the rank in a cursor compares equal to the one it came from
+    query = (
+        "SELECT id, TO_CHAR(date, 'YYYY-MM-DD') as date, organizer, title, description, is_public, rank "
+        "FROM (SELECT events.*, ts_rank(search, terms)::real AS rank "
+        "FROM events, websearch_to_tsquery('english', %s) AS terms WHERE search @@ terms"
+    )
+    params = [text]
+
+    if is_public is not None:
+        query += " AND is_public = %s"
+        params.append(is_public)
+
+    query += ") AS matches"
+
+    if after is not None:
+        query += " WHERE rank < %s::real OR (rank = %s::real AND id > %s)"
+        params.extend([after[0], after[0], after[1]])
+
+    # Fetch one extra row to know whether there is a next page
+    query += " ORDER BY rank DESC, id LIMIT %s"
+    params.append(limit + 1)
+
+    return query, tuple(params)
+
+
+async def search_events(
+    text, version, is_public=None, after=None, limit=DEFAULT_PAGE_SIZE
+):
+    events = await select_events(
+        *build_search_query(text, is_public=is_public, after=after, limit=limit),
+        version,
+    )
+
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = encode_cursor(events[-1]["rank"], events[-1]["id"])
+    return {
+        "events": [
+            {key: value for key, value in event.items() if key != "rank"}
+            for event in events
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+async def fetch_events(
+    is_public=None,
+    ids=None,
+    date_from=None,
+    date_to=None,
+    organizer=None,
+    limit=None,
+    cursor=None,
+    descending=False,
+    stream=False,
+    if_none_match=None,
+):
+    if stream and (limit is not None or cursor is not None):
         return JSONResponse(
-            content={"error": "Failed to fetch events", "detail": str(error)},
+            content={"error": "A streamed response can't be paginated"},
             status_code=400,
         )
-    finally:
-        cur.close()
-        conn.close()
+
+    # A page starts after the (date, id) of the last event of the previous page
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor, 2)
+        except ValueError as error:
+            return JSONResponse(content={"error": str(error)}, status_code=400)
+    if after is not None and limit is None:
+        limit = DEFAULT_PAGE_SIZE
+
+    filters = {
+        "is_public": is_public,
+        "ids": ids,
+        "date_from": date_from,
+        "date_to": date_to,
+        "organizer": organizer,
+    }
+
+    if stream:
+        return streams.response(*build_events_query(descending=descending, **filters))
+
+    # Responses carry the data version as ETag, a client that already has the current
+    # version gets a 304 without the events being queried or serialized
+    try:
+        version = await current_version()
+        if version.matches(if_none_match):
+            return version.not_modified()
+
+        # Plain id lookups are served from the per-event cache
+        ranged = date_from is not None or date_to is not None or organizer is not None
+        if ids is not None and limit is None and not ranged:
+            events = await lookup_events_by_id(ids, version, is_public=is_public)
+            return version.response({"events": events})
+
+        # Listings are cached per version, so a listing is never served with a version
+        # it wasn't read at, also when another replica wrote the events
+        key = (
+            version.version,
+            is_public,
+            tuple(ids) if ids is not None else None,
+            date_from,
+            date_to,
+            organizer,
+            limit,
+            cursor,
+            descending,
+        )
+        content = listing_cache.get(key)
+        if content is None:
+            content = await list_events(
+                version, after=after, limit=limit, descending=descending, **filters
+            )
+            listing_cache.set(key, content)
+        return version.response(content)
+    except QueryError as error:
+        return error.response()
+
+
+def invalidate_event(event_id):
+    """Drop everything cached about an event, to be called whenever it is created, updated or deleted."""
+    event_cache.invalidate(event_id)
+    listing_cache.clear()
+
+
+# The id filter can be repeated (?id=1&id=2) to fetch several events in one call.
+# from and to return the events between two dates (both inclusive) ordered by date.
+# With limit the events are returned one page at a time ordered by date, pass the
+# returned next_cursor as cursor to get the next page. order=desc returns the latest
+# events first, and the pages go back in time.
+# With stream all matching events are streamed as NDJSON (one event per line) instead.
+@app.get("/events/")
+async def get_events(
+    is_public: Optional[bool] = Query(None),
+    id: Optional[List[int]] = Query(None),
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    organizer: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    order: Literal["asc", "desc"] = Query("asc"),
+    stream: bool = Query(False),
+    if_none_match: Optional[str] = Header(None),
+):
+    return await fetch_events(
+        is_public=is_public,
+        ids=id,
+        date_from=date_from,
+        date_to=date_to,
+        organizer=organizer,
+        limit=limit,
+        cursor=cursor,
+        descending=order == "desc",
+        stream=stream,
+        if_none_match=if_none_match,
+    )
+
+
+# Same as GET /events/ but for id sets that are too large for a query string
+@app.post("/events/lookup")
+async def lookup_events(
+    lookup: EventLookup, if_none_match: Optional[str] = Header(None)
+):
+    return await fetch_events(
+        is_public=lookup.is_public, ids=lookup.ids, if_none_match=if_none_match
+    )
+
+
+# Full-text search over the title and description of events, best matches first. q takes
+# web search syntax ("quoted phrases", or, -excluded). Pass the returned next_cursor as cursor
+# to get the next page.
+@app.get("/events/search")
+async def get_search(
+    q: str = Query(..., min_length=1),
+    is_public: Optional[bool] = Query(None),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    if_none_match: Optional[str] = Header(None),
+):
+    # A page starts after the (rank, id) of the last event of the previous page
+    after = None
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor, 2)
+        except ValueError as error:
+            return JSONResponse(content={"error": str(error)}, status_code=400)
+
+    try:
+        version = await current_version()
+        if version.matches(if_none_match):
+            return version.not_modified()
+
+        key = ("search", version.version, q, is_public, limit, cursor)
+        content = listing_cache.get(key)
+        if content is None:
+            content = await search_events(
+                q, version, is_public=is_public, after=after, limit=limit
+            )
+            listing_cache.set(key, content)
+        return version.response(content)
+    except QueryError as error:
+        return error.response()
+
+
+# The changes to events, oldest first. Pass the returned next_cursor as cursor to get the
+# changes after them. With wait the request waits up to that many seconds for a change
+# when there are none yet (long polling).
+@app.get("/changes")
+async def get_changes(
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_CHANGES_LIMIT, ge=1, le=MAX_CHANGES_LIMIT),
+    wait: float = Query(0, ge=0, le=MAX_CHANGES_WAIT),
+):
+    try:
+        content = await changes.read(cursor=cursor, limit=limit, wait=wait)
+    except ValueError as error:
+        return JSONResponse(content={"error": str(error)}, status_code=400)
+    except (psycopg.Error, PoolTimeout) as error:
+        return JSONResponse(
+            content={"error": "Failed to fetch changes", "detail": str(error)},
+            status_code=500,
+        )
+    return JSONResponse(content=content, status_code=200)
@@ -0,0 +1,9 @@
+-- Schema created by db/init.sql, so databases created without it end up the same
+CREATE TABLE IF NOT EXISTS events (
+    id SERIAL PRIMARY KEY,
+    date DATE NOT NULL,
+    organizer VARCHAR(100) NOT NULL,
+    title VARCHAR(100) NOT NULL,
+    description TEXT,
+    is_public BOOLEAN NOT NULL
+);
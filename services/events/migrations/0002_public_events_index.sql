@@ -0,0 +1,2 @@
+-- The homepage lists public events ordered by date
+CREATE INDEX IF NOT EXISTS events_is_public_date_idx ON events (is_public, date, id);
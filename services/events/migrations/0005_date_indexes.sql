@@ -0,0 +1,3 @@
+-- Date range queries (GET /events?from=&to=) over all events, and over the events of one organizer
+CREATE INDEX IF NOT EXISTS events_date_idx ON events (date, id);
+CREATE INDEX IF NOT EXISTS events_organizer_date_idx ON events (organizer, date, id);
@@ -0,0 +1,52 @@
+-- migrate: no-transaction
+-- Full-text search over title (weighted highest) and description for GET /events/search.
+-- The search column is kept up to date by a trigger: adding it as a generated column would
+-- rewrite the whole table under an exclusive lock. Existing events are filled in batches and
+-- the index is built concurrently, so events can be read and written while this runs.
+ALTER TABLE events ADD COLUMN IF NOT EXISTS search tsvector;
+
+CREATE OR REPLACE FUNCTION events_search_document(title TEXT, description TEXT) RETURNS tsvector AS $$
+    SELECT setweight(to_tsvector('english', title), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION events_search_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search := events_search_document(NEW.title, NEW.description);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT FROM pg_trigger WHERE tgrelid = 'events'::regclass AND tgname = 'events_search') THEN
+        CREATE TRIGGER events_search BEFORE INSERT OR UPDATE OF title, description ON events
+            FOR EACH ROW EXECUTE FUNCTION events_search_update();
+    END IF;
+END $$;
+
+-- Events created from now on are filled by the trigger, the ones before in batches of
+-- ids that commit one by one, so no batch holds its row locks for long
+DO $$
+DECLARE
+    last_id INT := 0;
+    max_id INT;
+BEGIN
+    SELECT coalesce(max(id), 0) INTO max_id FROM events;
+    WHILE last_id < max_id LOOP
+        UPDATE events SET search = events_search_document(title, description)
+            WHERE id > last_id AND id <= last_id + 5000 AND search IS NULL;
+        last_id := last_id + 5000;
+        COMMIT;
+    END LOOP;
+END $$;
+
+-- An interrupted concurrent build leaves an invalid index behind, which is built again
+DO $$
+BEGIN
+    IF EXISTS (SELECT FROM pg_index WHERE indexrelid = to_regclass('events_search_idx') AND NOT indisvalid) THEN
+        DROP INDEX events_search_idx;
+    END IF;
+END $$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS events_search_idx ON events USING GIN (search);
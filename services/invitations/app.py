@@ -1,12 +1,44 @@
-from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel
-from fastapi.responses import JSONResponse
+import asyncio
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Optional
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import FastAPI, HTTPException, Query, Header
+from pydantic import BaseModel
+import psycopg
+from psycopg.rows import dict_row
+from common.conditional import read_version
+from common.compression import CompressionMiddleware
+from common.db import AsyncConnectionPool, PoolTimeout
+from common.metrics import MetricsMiddleware, metrics_response
+from common.migrations import migrate_database, migrate_on_startup
+from common.outbox import (
+    ChangeFeed,
+    DEFAULT_CHANGES_LIMIT,
+    MAX_CHANGES_LIMIT,
+    MAX_CHANGES_WAIT,
+)
+from common.responses import JSONResponse, QueryError
+from common.singleflight import SingleFlight, query_key
+from common.streaming import RowStreams
+from common.tracing import TracingMiddleware
+from events_client import EventsClient, EventsUnavailable
+from typing import Optional, List, Literal
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await apply_migrations()
+    await open_pool()
+    try:
+        yield
+    finally:
+        await close_pool()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, service="invitations")
 
 
 class Invitation(BaseModel):
@@ -15,6 +47,12 @@ class Invitation(BaseModel):
     status: str = None
 
 
+class InvitationBatch(BaseModel):
+    invitations: List[Invitation]
+    # What to do with invitations that already exist: keep the existing row, overwrite its status or fail the whole batch
+    on_conflict: Literal["ignore", "update", "error"] = "ignore"
+
+
 class InvitationRequest(BaseModel):
     invitee: Optional[str] = None
     status: Optional[str] = None
@@ -30,25 +68,138 @@ class InvitationRequest(BaseModel):
         }
 
 
-def get_db_connection():
+pool = AsyncConnectionPool("invitations")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+# Concurrent identical reads (e.g. everyone opening a popular event) run only one query
+flights = SingleFlight()
+
+events_client = EventsClient()
+
+changes = ChangeFeed(pool, "invitations")
+
+# Exports with stream=true, each holds a connection until it is sent
+streams = RowStreams(pool)
+
+# The columns of calendar_entries that are copied from the event
+EVENT_DETAILS = ("title", "date", "organizer", "is_public")
+
+# Copies the invitations written by the statement in the "written" CTE into the calendar
+# projection, together with the details of their events (passed as unnest() arrays).
+# Events that weren't passed leave the details NULL, they are filled in on the first read.
+PROJECT_WRITTEN_INVITATIONS = (
+    "INSERT INTO calendar_entries (invitee, event_id, status, title, date, organizer, is_public) "
+    "SELECT written.invitee, written.event_id, written.status, e.title, e.date, e.organizer, e.is_public "
+    "FROM written LEFT JOIN unnest(%s::int[], %s::varchar[], %s::date[], %s::varchar[], %s::bool[]) "
+    "AS e (event_id, title, date, organizer, is_public) ON e.event_id = written.event_id "
+    "ON CONFLICT (invitee, event_id) DO UPDATE SET status = EXCLUDED.status, "
+    "title = COALESCE(EXCLUDED.title, calendar_entries.title), "
+    "date = COALESCE(EXCLUDED.date, calendar_entries.date), "
+    "organizer = COALESCE(EXCLUDED.organizer, calendar_entries.organizer), "
+    "is_public = COALESCE(EXCLUDED.is_public, calendar_entries.is_public)"
+)
+
+# Records the invitations written by the statement in the "written" CTE in the outbox
+RECORD_WRITTEN_INVITATIONS = (
+    "INSERT INTO outbox (type, payload) "
+    "SELECT CASE WHEN written.inserted THEN 'invitation.created' ELSE 'invitation.updated' END, "
+    "jsonb_build_object('event_id', written.event_id, 'invitee', written.invitee, 'status', written.status) "
+    "FROM written"
+)
+
+
+async def get_db_connection():
     try:
-        return psycopg2.connect(
-            dbname="invitations",
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=os.environ["DATABASE_HOST"],
-            port="5432",
-        )
-    except psycopg2.Error as e:
+        return await pool.getconn()
+    except (psycopg.Error, PoolTimeout) as e:
         print("Unable to connect to the database")
         print(e)
         return None
 
 
+async def apply_migrations():
+    if not migrate_on_startup():
+        return
+    try:
+        await asyncio.to_thread(migrate_database, "invitations", MIGRATIONS_DIR)
+    except psycopg.Error as e:
+        print("Unable to apply the database migrations")
+        print(e)
+        # Without its schema every query of the service fails, so it doesn't start
+        raise
+
+
+async def open_pool():
+    try:
+        await pool.open()
+    except psycopg.Error as e:
+        print("Unable to open the database pool")
+        print(e)
+    await changes.start()
+
+
+async def close_pool():
+    await changes.stop()
+    await pool.close()
+    await events_client.close()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return metrics_response()
+
+
+@app.get("/pool/stats")
+async def pool_stats():
+    return JSONResponse(content=pool.stats(), status_code=200)
+
+
+@app.get("/single-flight/stats")
+async def single_flight_stats():
+    return JSONResponse(content=flights.stats(), status_code=200)
+
+
+def with_changes(write_query, select="SELECT 1"):
+    """
+    Make a write to invitations also update the calendar projection and record the change in the
+    outbox, in the same statement so they can't diverge. The write must return the event_id, invitee,
+    status and whether it inserted (or updated) each row it wrote.
+    """
+    return (
+        f"WITH written AS ({write_query}), "
+        f"projected AS ({PROJECT_WRITTEN_INVITATIONS}), "
+        f"recorded AS ({RECORD_WRITTEN_INVITATIONS}) {select}"
+    )
+
+
+def event_columns(events):
+    """The events as parameters for PROJECT_WRITTEN_INVITATIONS."""
+    return (
+        [event["id"] for event in events],
+        [event["title"] for event in events],
+        [event["date"] for event in events],
+        [event["organizer"] for event in events],
+        [event["is_public"] for event in events],
+    )
+
+
+async def lookup_events(event_ids):
+    """The events with the given ids, or none if the events service can't be reached."""
+    try:
+        return list((await events_client.lookup(set(event_ids))).values())
+    except EventsUnavailable as e:
+        # The calendar entries are completed when they are read
+        print(e)
+        return []
+
+
 # Create an invitation
 @app.post("/invitations/")
 async def create_invitation(invitation: Invitation):
-    conn = get_db_connection()
+    events = await lookup_events([invitation.event_id])
+
+    conn = await get_db_connection()
     if conn is None:
         return JSONResponse(
             content={"error": "Unable to connect to the database"}, status_code=500
@@ -56,80 +207,195 @@ async def create_invitation(invitation: Invitation):
 
     cur = conn.cursor()
     try:
-        cur.execute(
-            "INSERT INTO invitations (event_id, invitee, status) VALUES (%s, %s, %s)",
-            (invitation.event_id, invitation.invitee, invitation.status),
+        await cur.execute(
+            with_changes(
+                "INSERT INTO invitations (event_id, invitee, status) VALUES (%s, %s, %s) "
+                "RETURNING event_id, invitee, status, true AS inserted"
+            ),
+            (
+                invitation.event_id,
+                invitation.invitee,
+                invitation.status,
+                *event_columns(events),
+            ),
         )
-        conn.commit()
+        await conn.commit()
         return JSONResponse(
             content={
                 "message": "Invitation created successfully",
             },
             status_code=201,
         )
-    except psycopg2.Error as error:
-        conn.rollback()
+    except psycopg.Error as error:
+        await conn.rollback()
         return JSONResponse(
             content={"error": "Failed to create invitation", "detail": str(error)},
             status_code=400,
         )
     finally:
-        cur.close()
-        conn.close()
+        await cur.close()
+        await pool.putconn(conn)
 
 
-# Get invitations based on the query parameters
-@app.get("/invitations/")
-async def get_invitations(
-    invitee: Optional[str] = Query(None),
-    status: Optional[str] = Query(None),
-    event: Optional[int] = Query(None),
-):
-    conn = get_db_connection()
+# Create many invitations at once, all rows are inserted with one statement in one transaction
+@app.post("/invitations/batch")
+async def create_invitations(batch: InvitationBatch):
+    # Later duplicates within the batch win, a row can only be inserted once per statement
+    rows = {
+        (invitation.event_id, invitation.invitee): invitation.status
+        for invitation in batch.invitations
+    }
+    if not rows:
+        return JSONResponse(
+            content={
+                "message": "No invitations to create",
+                "created": 0,
+                "updated": 0,
+                "skipped": 0,
+            },
+            status_code=201,
+        )
+
+    events = await lookup_events([event_id for event_id, _ in rows])
+
+    conn = await get_db_connection()
     if conn is None:
         return JSONResponse(
             content={"error": "Unable to connect to the database"}, status_code=500
         )
 
+    query = (
+        "INSERT INTO invitations (event_id, invitee, status) "
+        "SELECT * FROM unnest(%s::int[], %s::varchar[], %s::varchar[])"
+    )
+    if batch.on_conflict == "ignore":
+        query += " ON CONFLICT (event_id, invitee) DO NOTHING"
+    elif batch.on_conflict == "update":
+        query += (
+            " ON CONFLICT (event_id, invitee) DO UPDATE SET status = EXCLUDED.status"
+        )
+    # xmax is only set for rows that already existed, which tells inserts and updates apart
+    query += " RETURNING event_id, invitee, status, (xmax = 0) AS inserted"
+    query = with_changes(query, select="SELECT inserted FROM written")
+
+    event_ids = [event_id for event_id, _ in rows]
+    invitees = [invitee for _, invitee in rows]
+    statuses = list(rows.values())
+
+    cur = conn.cursor()
+    try:
+        await cur.execute(
+            query, (event_ids, invitees, statuses, *event_columns(events))
+        )
+        inserted = [row[0] for row in await cur.fetchall()]
+        await conn.commit()
+        return JSONResponse(
+            content={
+                "message": "Invitations created successfully",
+                "created": inserted.count(True),
+                "updated": inserted.count(False),
+                "skipped": len(rows) - len(inserted),
+            },
+            status_code=201,
+        )
+    except psycopg.Error as error:
+        await conn.rollback()
+        return JSONResponse(
+            content={"error": "Failed to create invitations", "detail": str(error)},
+            status_code=400,
+        )
+    finally:
+        await cur.close()
+        await pool.putconn(conn)
+
+
+# Get invitations based on the query parameters, every filter can be repeated to match any of several values.
+# With stream the invitations are streamed as NDJSON (one invitation per line) instead of one JSON document.
+@app.get("/invitations/")
+async def get_invitations(
+    invitee: Optional[List[str]] = Query(None),
+    status: Optional[List[str]] = Query(None),
+    event: Optional[List[int]] = Query(None),
+    stream: bool = Query(False),
+    if_none_match: Optional[str] = Header(None),
+):
     query = "SELECT event_id, invitee, status FROM invitations"
     params = []
     conditions = []
 
     if invitee is not None:
-        conditions.append("invitee = %s")
+        conditions.append("invitee = ANY(%s)")
         params.append(invitee)
 
     if status is not None:
-        conditions.append("status = %s")
+        conditions.append("status = ANY(%s)")
         params.append(status)
 
     if event is not None:
-        conditions.append("event_id = %s")
+        conditions.append("event_id = ANY(%s)")
         params.append(event)
 
     if conditions:
         query += " WHERE " + " AND ".join(conditions)
 
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if stream:
+        return streams.response(query, tuple(params))
+
     try:
-        cur.execute(query, tuple(params))
-        invitations = cur.fetchall()
-        return JSONResponse(content={"invitations": invitations}, status_code=200)
-    except psycopg2.Error as error:
-        conn.rollback()
-        return JSONResponse(
-            content={"error": "Failed to fetch invitations", "detail": str(error)},
-            status_code=400,
+        # A client that already has the current version gets a 304 without the query being run
+        version = await current_version("invitations")
+        if version.matches(if_none_match):
+            return version.not_modified()
+        # Identical queries that arrive while one is running share its result, if they read
+        # the same version: a query that started before a write must not be answered with
+        # the version after it
+        invitations = await flights.do(
+            (version.version, query_key(query, params)),
+            lambda: select_invitations(query, tuple(params)),
+        )
+        return version.response({"invitations": invitations})
+    except QueryError as error:
+        return error.response()
+
+
+async def current_version(name):
+    conn = await get_db_connection()
+    if conn is None:
+        raise QueryError({"error": "Unable to connect to the database"}, 500)
+
+    try:
+        return await read_version(conn, name)
+    except psycopg.Error as error:
+        raise QueryError(
+            {"error": "Failed to fetch the data version", "detail": str(error)}, 500
+        )
+    finally:
+        await pool.putconn(conn)
+
+
+async def select_invitations(query, params):
+    conn = await get_db_connection()
+    if conn is None:
+        raise QueryError({"error": "Unable to connect to the database"}, 500)
+
+    cur = conn.cursor(row_factory=dict_row)
+    try:
+        await cur.execute(query, params)
+        return await cur.fetchall()
+    except psycopg.Error as error:
+        await conn.rollback()
+        raise QueryError(
+            {"error": "Failed to fetch invitations", "detail": str(error)}, 400
         )
     finally:
-        cur.close()
-        conn.close()
+        await cur.close()
+        await pool.putconn(conn)
 
 
 # Update invitation status of an invitee for a specific event
 @app.patch("/invitations/{event_id}/{invitee}")
 async def update_invitation_status(event_id: int, invitee: str, status: str):
-    conn = get_db_connection()
+    conn = await get_db_connection()
     if conn is None:
         return JSONResponse(
             content={"error": "Unable to connect to the database"}, status_code=500
@@ -137,20 +403,161 @@ async def update_invitation_status(event_id: int, invitee: str, status: str):
 
     cur = conn.cursor()
     try:
-        cur.execute(
-            "UPDATE invitations SET status = %s WHERE event_id = %s AND invitee = %s;",
-            (status, event_id, invitee),
+        await cur.execute(
+            with_changes(
+                "UPDATE invitations SET status = %s WHERE event_id = %s AND invitee = %s "
+                "RETURNING event_id, invitee, status, false AS inserted"
+            ),
+            (status, event_id, invitee, *event_columns([])),
         )
-        conn.commit()
+        await conn.commit()
         return JSONResponse(
             content={"message": "Invitation updated successfully"}, status_code=200
         )
-    except psycopg2.Error as error:
-        conn.rollback()
+    except psycopg.Error as error:
+        await conn.rollback()
         return JSONResponse(
             content={"error": "Failed to update invitation", "detail": str(error)},
             status_code=400,
         )
     finally:
-        cur.close()
-        conn.close()
+        await cur.close()
+        await pool.putconn(conn)
+
+
+# The calendar of a user: their invitations with the details of each event, ordered by date.
+# The status filter can be repeated to match any of several statuses, from and to only
+# return the events between two dates (both inclusive).
+@app.get("/calendar/{invitee}")
+async def get_calendar(
+    invitee: str,
+    status: Optional[List[str]] = Query(None),
+    date_from: Optional[date] = Query(None, alias="from"),
+    date_to: Optional[date] = Query(None, alias="to"),
+    if_none_match: Optional[str] = Header(None),
+):
+    query = (
+        "SELECT event_id, title, TO_CHAR(date, 'YYYY-MM-DD') AS date, organizer, status, is_public "
+        "FROM calendar_entries WHERE invitee = %s"
+    )
+    params = [invitee]
+    if status is not None:
+        query += " AND status = ANY(%s)"
+        params.append(status)
+    if date_from is not None or date_to is not None:
+        # Entries without details have no date yet, they are read in a branch of their own
+        # (checked once they are completed) so the dates stay bounds of the index scan
+        incomplete = query + " AND title IS NULL"
+        incomplete_params = list(params)
+        if date_from is not None:
+            query += " AND date >= %s"
+            params.append(date_from)
+        if date_to is not None:
+            query += " AND date <= %s"
+            params.append(date_to)
+        query += " UNION ALL " + incomplete
+        params.extend(incomplete_params)
+    query += " ORDER BY date, event_id"
+
+    try:
+        # Each calendar has its own version, invitations of other users don't change it
+        version = await current_version(f"calendar_entries:{invitee}")
+        if version.matches(if_none_match):
+            return version.not_modified()
+        entries = await flights.do(
+            (version.version, query_key(query, params)),
+            lambda: select_calendar(query, tuple(params)),
+        )
+        entries = [
+            entry
+            for entry in entries
+            if (date_from is None or entry["date"] >= date_from.isoformat())
+            and (date_to is None or entry["date"] <= date_to.isoformat())
+        ]
+        return version.response({"invitee": invitee, "calendar": entries})
+    except QueryError as error:
+        return error.response()
+
+
+async def select_calendar(query, params):
+    entries = await select_invitations(query, params)
+
+    incomplete = [entry for entry in entries if entry["title"] is None]
+    if not incomplete:
+        return entries
+
+    # Entries written while the events service was unreachable, or from before the projection existed
+    completed = await complete_calendar_entries(
+        {entry["event_id"] for entry in incomplete}
+    )
+    calendar = []
+    for entry in entries:
+        if entry["title"] is None:
+            event = completed.get(entry["event_id"])
+            if event is None:
+                continue
+            entry = {**entry, **{key: event[key] for key in EVENT_DETAILS}}
+        calendar.append(entry)
+    # Completed entries may no longer be in date order
+    calendar.sort(key=lambda entry: (entry["date"], entry["event_id"]))
+    return calendar
+
+
+async def complete_calendar_entries(event_ids):
+    """
+    Copy the details of the given events into every calendar entry of them, entries of events
+    that don't exist are removed. Returns the events that were found.
+    """
+    try:
+        events = await events_client.lookup(event_ids)
+    except EventsUnavailable as e:
+        print(e)
+        return {}
+
+    conn = await get_db_connection()
+    if conn is None:
+        # The entries can still be shown, they are completed on a later read
+        return events
+
+    cur = conn.cursor()
+    try:
+        await cur.execute(
+            "UPDATE calendar_entries SET title = e.title, date = e.date, organizer = e.organizer, is_public = e.is_public "
+            "FROM unnest(%s::int[], %s::varchar[], %s::date[], %s::varchar[], %s::bool[]) "
+            "AS e (event_id, title, date, organizer, is_public) "
+            "WHERE calendar_entries.event_id = e.event_id AND calendar_entries.title IS NULL",
+            event_columns(events.values()),
+        )
+        await cur.execute(
+            "DELETE FROM calendar_entries WHERE event_id = ANY(%s) AND title IS NULL",
+            ([event_id for event_id in event_ids if event_id not in events],),
+        )
+        await conn.commit()
+    except psycopg.Error as error:
+        await conn.rollback()
+        print(error)
+    finally:
+        await cur.close()
+        await pool.putconn(conn)
+    return events
+
+
+# The changes to invitations, oldest first. Pass the returned next_cursor as cursor to get the
+# changes after them. With wait the request waits up to that many seconds for a change
+# when there are none yet (long polling).
+@app.get("/changes")
+async def get_changes(
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(DEFAULT_CHANGES_LIMIT, ge=1, le=MAX_CHANGES_LIMIT),
+    wait: float = Query(0, ge=0, le=MAX_CHANGES_WAIT),
+):
+    try:
+        content = await changes.read(cursor=cursor, limit=limit, wait=wait)
+    except ValueError as error:
+        return JSONResponse(content={"error": str(error)}, status_code=400)
+    except (psycopg.Error, PoolTimeout) as error:
+        return JSONResponse(
+            content={"error": "Failed to fetch changes", "detail": str(error)},
+            status_code=500,
+        )
+    return JSONResponse(content=content, status_code=200)
@@ -0,0 +1,51 @@
+"""
+Client for the events service, used to copy event details into the calendar projection.
+"""
+
+import os
+
+import httpx
+
+from common.tracing import span, traceparent_headers
+
+EVENTS_SERVICE_URL = os.environ.get("EVENTS_SERVICE_URL", "http://events:5000")
+EVENTS_SERVICE_TIMEOUT = float(os.environ.get("EVENTS_SERVICE_TIMEOUT", 2))
+
+
+class EventsUnavailable(Exception):
+    pass
+
+
+class EventsClient:
+    def __init__(self, base_url=EVENTS_SERVICE_URL, timeout=EVENTS_SERVICE_TIMEOUT):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout
+            )
+        return self._client
+
+    async def lookup(self, ids):
+        """The events with the given ids keyed by id, events that don't exist are left out."""
+        if not ids:
+            return {}
+        with span("POST events /events/lookup", event_ids=len(ids)):
+            try:
+                response = await self._get_client().post(
+                    "/events/lookup",
+                    json={"ids": list(ids)},
+                    headers=traceparent_headers(),
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                raise EventsUnavailable(f"Unable to look up events: {e}")
+        return {event["id"]: event for event in response.json()["events"]}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
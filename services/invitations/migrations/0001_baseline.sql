@@ -0,0 +1,7 @@
+-- Schema created by db/init.sql, so databases created without it end up the same
+CREATE TABLE IF NOT EXISTS invitations (
+    event_id INT NOT NULL,
+    invitee VARCHAR(100) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    PRIMARY KEY (event_id, invitee)
+);
@@ -0,0 +1,3 @@
+-- The calendar and invites pages look up the invitations of a user by status,
+-- the primary key (event_id, invitee) can't be used for that
+CREATE INDEX IF NOT EXISTS invitations_invitee_status_idx ON invitations (invitee, status);
@@ -0,0 +1,22 @@
+-- Calendar read model: every invitation together with a copy of its event, so a calendar
+-- is one indexed read instead of an invitations query plus an events lookup per page view.
+-- The event columns are NULL until the event details have been copied from the events service.
+CREATE TABLE IF NOT EXISTS calendar_entries (
+    invitee VARCHAR(100) NOT NULL,
+    event_id INT NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    title VARCHAR(100),
+    date DATE,
+    organizer VARCHAR(100),
+    is_public BOOLEAN,
+    PRIMARY KEY (invitee, event_id)
+);
+
+CREATE INDEX IF NOT EXISTS calendar_entries_invitee_date_idx ON calendar_entries (invitee, date, event_id);
+
+-- Entries with missing details are filled in when they are first read
+CREATE INDEX IF NOT EXISTS calendar_entries_incomplete_idx ON calendar_entries (event_id) WHERE title IS NULL;
+
+INSERT INTO calendar_entries (invitee, event_id, status)
+SELECT invitee, event_id, status FROM invitations
+ON CONFLICT DO NOTHING;
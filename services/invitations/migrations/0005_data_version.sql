@@ -0,0 +1,78 @@
+-- Versions of the tables below, bumped by every statement that changes rows of one of them,
+-- used as the ETag of reads, see common/conditional.py. Writers of a table serialize on its
+-- row until they commit, which keeps its version in commit order.
+CREATE TABLE IF NOT EXISTS data_version (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL,
+    changed_at TIMESTAMPTZ NOT NULL
+);
+
+INSERT INTO data_version (name, version, changed_at) VALUES ('invitations', 1, now()) ON CONFLICT DO NOTHING;
+
+-- Bumps the version of the table of the trigger. With a column as argument the table has a
+-- version per value of that column instead ("table:value"), so a write only changes the
+-- versions of the values it touched. The triggers pass the rows the statement changed as
+-- changed_rows, a statement that changed none (a DELETE that matched nothing, ON CONFLICT
+-- DO NOTHING) doesn't bump anything. TRUNCATE has no rows and bumps every version of the table.
+CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        UPDATE data_version SET version = version + 1, changed_at = now()
+            WHERE name = TG_TABLE_NAME OR starts_with(name, TG_TABLE_NAME || ':');
+    ELSIF TG_NARGS = 0 THEN
+        IF EXISTS (SELECT FROM changed_rows) THEN
+            INSERT INTO data_version (name, version, changed_at) VALUES (TG_TABLE_NAME, 1, now())
+                ON CONFLICT (name) DO UPDATE SET version = data_version.version + 1, changed_at = now();
+        END IF;
+    ELSE
+        -- In order, so writers touching the same values lock their rows in the same order
+        EXECUTE format(
+            'INSERT INTO data_version (name, version, changed_at) '
+            'SELECT DISTINCT %L || '':'' || %I, 1, now() FROM changed_rows ORDER BY 1 '
+            'ON CONFLICT (name) DO UPDATE SET version = data_version.version + 1, changed_at = now()',
+            TG_TABLE_NAME, TG_ARGV[0]
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- A trigger can only have the transition table of one kind of statement
+DROP TRIGGER IF EXISTS invitations_data_version_insert ON invitations;
+CREATE TRIGGER invitations_data_version_insert AFTER INSERT ON invitations
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+DROP TRIGGER IF EXISTS invitations_data_version_update ON invitations;
+CREATE TRIGGER invitations_data_version_update AFTER UPDATE ON invitations
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+DROP TRIGGER IF EXISTS invitations_data_version_delete ON invitations;
+CREATE TRIGGER invitations_data_version_delete AFTER DELETE ON invitations
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+DROP TRIGGER IF EXISTS invitations_data_version_truncate ON invitations;
+CREATE TRIGGER invitations_data_version_truncate AFTER TRUNCATE ON invitations
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version();
+
+-- Calendars are read per invitee, so each invitee has its own version
+DROP TRIGGER IF EXISTS calendar_entries_data_version_insert ON calendar_entries;
+CREATE TRIGGER calendar_entries_data_version_insert AFTER INSERT ON calendar_entries
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version('invitee');
+
+DROP TRIGGER IF EXISTS calendar_entries_data_version_update ON calendar_entries;
+CREATE TRIGGER calendar_entries_data_version_update AFTER UPDATE ON calendar_entries
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version('invitee');
+
+DROP TRIGGER IF EXISTS calendar_entries_data_version_delete ON calendar_entries;
+CREATE TRIGGER calendar_entries_data_version_delete AFTER DELETE ON calendar_entries
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version('invitee');
+
+DROP TRIGGER IF EXISTS calendar_entries_data_version_truncate ON calendar_entries;
+CREATE TRIGGER calendar_entries_data_version_truncate AFTER TRUNCATE ON calendar_entries
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version('invitee');
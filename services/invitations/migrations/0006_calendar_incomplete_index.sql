@@ -0,0 +1,3 @@
+-- Calendar entries of a user that still miss their event details, read next to the
+-- entries of a date range
+CREATE INDEX IF NOT EXISTS calendar_entries_invitee_incomplete_idx ON calendar_entries (invitee) WHERE title IS NULL;